@@ -0,0 +1,211 @@
+# EKF kernel benchmarks
+# Times the filter kernels (motion / observation models, their Jacobians, the
+# gain, quaternion normalization) and a whole predict + update step for a range
+# of landmark counts, on a synthetic scene so it runs without the dataset.
+# Compile time (lowering + XLA compilation, ahead of time) and steady-state
+# time (per call, after compilation) are measured separately and written to
+# JSON so runs of different versions can be compared.
+#
+#   python bench.py --sizes 10 50 200 1000 --precision float32 --out bench.json
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import numpy as onp
+
+import ekf
+from calib import StereoCamera
+from engine import _init_filter, _kalman_gain, _predict_sigma, _step
+from model import _A, _A_pose, _C, _C_structured, _f, _g, _normalize_q
+from precision import _dtypes
+
+# KITTI 00 left camera
+camera = StereoCamera(718.856, 718.856, 607.1928, 185.2157, 0.5371657)
+
+
+def _synthetic(num_landmarks, num_frames=10, dt=0.1, speed=2.0, yaw_rate=0.1,
+               seed=0):
+    """
+    Synthetic scene: landmarks (N, 3) spread over the first view (5 to 40 m
+    deep) and a camera driving forward at `speed` m/s while turning at
+    `yaw_rate` rad/s, starting at the identity pose.
+
+    Returns the landmarks, the camera positions (T, 3) and orientations
+    (wxyz, (T, 4)), the landmark pixel locations (T, 2N) with one pixel of
+    noise and whether each landmark is in view (T, N).
+    """
+    rng = onp.random.default_rng(seed)
+    uv = rng.uniform((0, 0), (camera.width, camera.height),
+                     (num_landmarks, 2))
+    z = rng.uniform(5, 40, num_landmarks)
+    disparity = camera.fx * camera.baseline / z
+    landmarks = camera.backproject_disparity(uv, disparity)
+
+    t = dt * onp.arange(num_frames)
+    theta = yaw_rate * t
+    # Forward is +z, yaw about +y (pointing down)
+    positions = onp.stack((speed * onp.cumsum(onp.sin(theta)) * dt,
+                           onp.zeros(num_frames),
+                           speed * onp.cumsum(onp.cos(theta)) * dt),
+                          axis=-1)
+    positions -= positions[0]
+    wxyz = onp.stack((onp.cos(theta / 2), onp.zeros(num_frames),
+                      onp.sin(theta / 2), onp.zeros(num_frames)),
+                     axis=-1)
+
+    ys, observed = [], []
+    for q, p in zip(wxyz, positions):
+        view = onp.asarray(camera.to_camera(q, p, landmarks))
+        ys.append(camera.project(view) + rng.normal(size=(num_landmarks, 2)))
+        observed.append(camera.in_frame(view))
+    ys = onp.array(ys).reshape((num_frames, -1))
+    return landmarks, positions, wxyz, ys, onp.array(observed)
+
+
+def _time(fn, *args, repeat=20, min_time=0.5):
+    """
+    Compile fn for args ahead of time, then call the compiled function at
+    least `repeat` times or for `min_time` seconds.
+
+    Returns the compile time and the median / min seconds per call.
+    """
+    t0 = time.perf_counter()
+    compiled = jax.jit(fn).lower(*args).compile()
+    compile_s = time.perf_counter() - t0
+
+    jax.block_until_ready(compiled(*args))
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeat or time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        jax.block_until_ready(compiled(*args))
+        times.append(time.perf_counter() - t0)
+        if len(times) >= 3 and time.perf_counter() - start > 10 * min_time:
+            # Slow kernel (large N), a few calls are enough
+            break
+    return compile_s, float(onp.median(times)), float(onp.min(times)), len(
+        times)
+
+
+def _kernels(num_landmarks, precision="float32", repair="symmetric",
+             dense=True):
+    """
+    (name, fn, args) for every benchmarked kernel, with inputs from the first
+    step of a synthetic scene with `num_landmarks` landmarks.
+    """
+    storage, accumulate = _dtypes(precision)
+    landmarks, _, _, ys, observed = _synthetic(num_landmarks)
+
+    mu, sigma, Q, R = _init_filter(jnp.asarray(landmarks),
+                                   jnp.asarray(ekf.v0, dtype=float),
+                                   ekf.q_pose, ekf.q_landmark, ekf.r_pixel,
+                                   ekf.sigma0_scale)
+    mu, sigma, Q, R = (x.astype(storage) for x in (mu, sigma, Q, R))
+    cam = camera.astype(storage)
+    dt = jnp.asarray(0.1, dtype=storage)
+    y = jnp.asarray(ys[1], dtype=storage)
+    observed = jnp.asarray(observed[1])
+
+    # Predicted state and covariance that the update kernels see
+    _mu = _f(mu, dt)
+    _sigma = _predict_sigma(sigma, _A_pose(mu, dt), Q)
+    C = _C_structured(_mu, cam)
+
+    kernels = [
+        ("_f", _f, (mu, dt)),
+        ("_A_pose", _A_pose, (mu, dt)),
+        ("_predict_sigma", _predict_sigma, (sigma, _A_pose(mu, dt), Q)),
+        ("_g", _g, (_mu, cam)),
+        ("_C_structured", _C_structured, (_mu, cam)),
+        ("gain", partial(_kalman_gain, accumulate=accumulate),
+         (_sigma, C, R)),
+        ("_normalize_q", _normalize_q, (_mu, )),
+        ("step",
+         partial(_step, Q, R, cam, 1.0, accumulate, repair),
+         ((mu, sigma), (dt, y, observed, None))),
+    ]
+    if dense:
+        # Autodiff over the whole state, O(n) forward passes each
+        kernels += [
+            ("_A", _A, (mu, dt)),
+            ("_C", _C, (_mu, cam)),
+        ]
+    return kernels
+
+
+def bench(sizes=(10, 50, 200, 1000), precision="float32", repair="symmetric",
+          dense=True, repeat=20, min_time=0.5):
+    """
+    Benchmark every kernel (see `_kernels`) for each landmark count in
+    `sizes`. Returns one dict per (kernel, size).
+    """
+    results = []
+    for N in sizes:
+        for name, fn, args in _kernels(N, precision, repair, dense):
+            compile_s, median_s, min_s, calls = _time(fn,
+                                                      *args,
+                                                      repeat=repeat,
+                                                      min_time=min_time)
+            results.append(
+                dict(kernel=name,
+                     landmarks=N,
+                     state=13 + 3 * N,
+                     compile_s=compile_s,
+                     median_s=median_s,
+                     min_s=min_s,
+                     calls=calls))
+            print(f"N = {N:5d} {name:15s} compile {compile_s:8.3f} s, "
+                  f"{1e3 * median_s:10.3f} ms (min {1e3 * min_s:.3f} ms)")
+    return results
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+                                capture_output=True,
+                                text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit,
+                python=platform.python_version(),
+                jax=jax.__version__,
+                numpy=onp.__version__,
+                machine=platform.machine(),
+                processor=platform.processor(),
+                devices=[str(d) for d in jax.devices()],
+                date=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",
+                        nargs="+",
+                        type=int,
+                        default=[10, 50, 200, 1000])
+    parser.add_argument("--precision", default=ekf.precision)
+    parser.add_argument("--repair", default=ekf.repair)
+    parser.add_argument("--no-dense",
+                        action="store_true",
+                        help="skip the autodiff _A / _C references")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--min-time", type=float, default=0.5)
+    parser.add_argument("--out", default="bench.json")
+    args = parser.parse_args()
+
+    repair = None if args.repair == "None" else args.repair
+    results = bench(args.sizes, args.precision, repair, not args.no_dense,
+                    args.repeat, args.min_time)
+    with open(args.out, "w") as f:
+        json.dump(dict(environment=_environment(),
+                       precision=args.precision,
+                       repair=repair,
+                       results=results),
+                  f,
+                  indent=2)
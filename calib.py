@@ -1,21 +1,158 @@
+from typing import NamedTuple
+
+import jax
 import jax.numpy as jnp
-from IPython import embed
+import numpy as onp
+
+from q import _to_local, _to_world
 
 calib_path = "/media/bryan/shared/kitti2/dataset/sequences/00/calib.txt"
 
 
+def _load_projections(p):
+    # Every line is "<name>: <12 values>", a 3 x 4 matrix (P0, P1, P2, P3, Tr)
+    return onp.loadtxt(p, usecols=range(1, 13), ndmin=2).reshape((-1, 3, 4))
+
+
 def _load_calib(p):
-    with open(p, "r") as f:
-        lines = [x.strip() for x in f.readlines()]
-        P0 = [float(x) for x in lines[0].split(" ")[1:]]
-        P1 = [float(x) for x in lines[1].split(" ")[1:]]
+    P = _load_projections(p)
+    P0 = jnp.array(P[0])
+    P1 = jnp.array(P[1])
+    return P0, P1
+
+
+def _np(x):
+    # numpy in, numpy out (front end); jax arrays / tracers in, jax out
+    return jnp if isinstance(x, jax.Array) else onp
+
+
+class StereoCamera(NamedTuple):
+    """
+    Rectified stereo pair: pinhole intrinsics of the left camera, the
+    baseline to the right camera and the image size.
+
+    Camera coordinate system is as follows
+    z pointing into the screen
+    ------> x
+    |
+    |
+    v
+    y
+
+    A NamedTuple, so it's a pytree and can be passed through jit / vmap /
+    scan. All methods work on batches of points, with numpy or jax arrays.
+    """
+    fx: float
+    fy: float
+    cx: float
+    cy: float
+    baseline: float  # m
+    width: int = 1241
+    height: int = 376
+
+    @classmethod
+    def from_projections(cls, P0, P1, width=1241, height=376):
+        """
+        From the 3 x 4 projection matrices of the left (reference) and right
+        cameras, P1 = P0 + [0 | (-fx * baseline, 0, 0)].
+        """
+        P0, P1 = onp.asarray(P0), onp.asarray(P1)
+        assert not P0[:, 3].any(), "left camera must be the reference"
+        fx = P0[0, 0]
+        return cls(fx, P0[1, 1], P0[0, 2], P0[1, 2], -P1[0, 3] / fx, width,
+                   height)
 
-        P0 = jnp.array(P0).reshape((3, 4))
-        P1 = jnp.array(P1).reshape((3, 4))
+    @classmethod
+    def load(cls, p, width=1241, height=376):
+        P = _load_projections(p)
+        return cls.from_projections(P[0], P[1], width, height)
 
-        return P0, P1
+    def astype(self, dtype):
+        return StereoCamera(*(jnp.asarray(x, dtype) for x in self))
+
+    def project(self, xyz):
+        """
+        Pixel locations (N, 2) of camera-space points xyz (N, 3).
+
+        Same as P0 @ [xyz, 1] and dividing by the homogeneous coordinate, but
+        without building the 4 x N matrix.
+        """
+        np = _np(xyz)
+        x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+        return np.stack((self.fx * x / z + self.cx, self.fy * y / z + self.cy),
+                        axis=-1)
+
+    def project_jacobian(self, xyz):
+        """
+        Jacobian of `project` with respect to xyz, (N, 2, 3).
+        """
+        np = _np(xyz)
+        x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+        zeros = np.zeros_like(z)
+        return np.stack((
+            np.stack((self.fx / z, zeros, -self.fx * x / z**2), axis=-1),
+            np.stack((zeros, self.fy / z, -self.fy * y / z**2), axis=-1),
+        ),
+                        axis=1)
+
+    def backproject_disparity(self, uv, disparity):
+        """
+        Camera-space points (N, 3) of pixels uv (N, 2) with stereo disparity
+        (N,) in pixels.
+        """
+        np = _np(disparity)
+        z = (self.fx * self.baseline) / disparity
+        x = (uv[:, 0] - self.cx) * (z / self.fx)
+        y = (uv[:, 1] - self.cy) * (z / self.fy)
+        return np.stack((x, y, z), axis=-1)
+
+    def backproject_cov(self, xyz):
+        """
+        Covariance (N, 3, 3) of back projected points xyz (N, 3) for unit
+        variance in the pixel location and disparity.
+        """
+        np = _np(xyz)
+        # Jacobian of (x, y, z) with respect to (u, v, disparity)
+        x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+        d_d = -z / (self.fx * self.baseline)
+        zeros = np.zeros_like(z)
+        J = np.stack((
+            np.stack((z / self.fx, zeros, x * d_d), axis=-1),
+            np.stack((zeros, z / self.fy, y * d_d), axis=-1),
+            np.stack((zeros, zeros, z * d_d), axis=-1),
+        ),
+                     axis=1)
+        return J @ np.swapaxes(J, 1, 2)
+
+    def inside(self, uv):
+        """
+        Whether each pixel coordinate is inside the image, (N, 2).
+        """
+        np = _np(uv)
+        return np.stack(((uv[:, 0] > 0) & (uv[:, 0] < self.width),
+                         (uv[:, 1] > 0) & (uv[:, 1] < self.height)),
+                        axis=-1)
+
+    def in_frame(self, xyz):
+        """
+        Visibility mask (N,) of camera-space points: in front of the camera
+        and projecting inside the image.
+        """
+        return (xyz[:, 2] > 0) & self.inside(self.project(xyz)).all(axis=-1)
+
+    # World <-> camera for a camera at position p with orientation wxyz
+    @staticmethod
+    def to_camera(wxyz, p, xyz):
+        return _to_local(wxyz, p, xyz)
+
+    @staticmethod
+    def to_world(wxyz, p, xyz):
+        return _to_world(wxyz, p, xyz)
 
 
 if __name__ == "__main__":
+    from IPython import embed
+
     P0, P1 = _load_calib(calib_path)
+    camera = StereoCamera.load(calib_path)
     embed()
\ No newline at end of file
@@ -0,0 +1,137 @@
+# KITTI odometry sequence metadata
+# Poses, timestamps, image lists and calibration are parsed in one vectorized
+# pass and cached as `metadata.npz` inside the sequence directory, so later
+# runs (and batch jobs opening many sequences) only pay for a single .npz load.
+
+import os
+import threading
+from functools import cached_property
+from pathlib import Path
+
+import numpy as onp
+
+import calib
+
+_cache_name = "metadata.npz"
+
+
+def _load_names(p):
+    return onp.array(Path(p).read_text().split())
+
+
+class KittiSequence:
+    """
+    KITTI odometry sequence laid out as
+
+        <root>/sequences/<seq>/{calib.txt, times.txt, left_imgs.txt, ...}
+        <root>/poses/<seq>.txt (ground truth, only for sequences 00-10)
+
+    Metadata is loaded lazily on first access.
+    """
+
+    def __init__(self, root, seq="00", cache=True):
+        self.root = Path(root)
+        self.seq = seq
+        self.path = self.root / "sequences" / seq
+        self.calib_path = self.path / "calib.txt"
+        self.times_path = self.path / "times.txt"
+        self.poses_path = self.root / "poses" / f"{seq}.txt"
+        self.cache_path = self.path / _cache_name
+        self.cache = cache
+        self._meta = None
+
+    def _sources(self):
+        sources = [
+            self.calib_path,
+            self.times_path,
+            self.path / "left_imgs.txt",
+            self.path / "right_imgs.txt",
+        ]
+        if self.poses_path.exists():
+            sources.append(self.poses_path)
+        return sources
+
+    def _parse(self):
+        P = calib._load_projections(self.calib_path)
+        meta = dict(
+            times=onp.loadtxt(self.times_path, ndmin=1),
+            left_imgs=_load_names(self.path / "left_imgs.txt"),
+            right_imgs=_load_names(self.path / "right_imgs.txt"),
+            P0=P[0],
+            P1=P[1],
+        )
+        if self.poses_path.exists():
+            meta["poses"] = onp.loadtxt(self.poses_path,
+                                        ndmin=2).reshape((-1, 3, 4))
+
+        assert len(meta["left_imgs"]) == len(meta["right_imgs"])
+        assert len(meta["left_imgs"]) == len(meta["times"])
+        return meta
+
+    def _fresh(self):
+        if not self.cache_path.exists():
+            return False
+        mtime = self.cache_path.stat().st_mtime
+        return all(p.stat().st_mtime <= mtime for p in self._sources())
+
+    def _load(self):
+        if self._meta is not None:
+            return self._meta
+
+        if self.cache and self._fresh():
+            with onp.load(self.cache_path) as f:
+                self._meta = dict(f)
+        else:
+            self._meta = self._parse()
+            if self.cache:
+                # Write to a temporary file first, so that concurrent runs
+                # (e.g. runner.py workers) never read a partial cache
+                tmp = self.cache_path.with_suffix(
+                    f".{os.getpid()}.{threading.get_ident()}.tmp")
+                try:
+                    with open(tmp, "wb") as f:
+                        onp.savez(f, **self._meta)
+                    os.replace(tmp, self.cache_path)
+                except OSError:
+                    # Read-only dataset, just parse again next time
+                    tmp.unlink(missing_ok=True)
+        return self._meta
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def times(self):
+        # In seconds
+        return self._load()["times"]
+
+    # Built once: the front end indexes these every frame
+    @cached_property
+    def left_img_paths(self):
+        return [self.path / "image_0" / x for x in self._load()["left_imgs"]]
+
+    @cached_property
+    def right_img_paths(self):
+        return [self.path / "image_1" / x for x in self._load()["right_imgs"]]
+
+    @property
+    def P0(self):
+        return self._load()["P0"]
+
+    @property
+    def P1(self):
+        return self._load()["P1"]
+
+    @property
+    def camera(self):
+        return calib.StereoCamera.from_projections(self.P0, self.P1)
+
+    @property
+    def poses(self):
+        # (N, 3, 4) camera-to-world ground truth, None for test sequences
+        return self._load().get("poses")
+
+    @property
+    def gt_positions(self):
+        poses = self.poses
+        return None if poses is None else poses[:, :, -1]
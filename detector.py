@@ -0,0 +1,98 @@
+# Grid-bucketed corner detection
+# A single goodFeaturesToTrack call over the whole frame tends to cluster its
+# corners on the most textured region. Detecting per grid cell (with a quota
+# per cell) spreads them out, and the cells are independent so they run on a
+# thread pool (OpenCV releases the GIL).
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as onp
+
+
+def _suppress(corners, scores, min_distance):
+    """
+    Greedy non-maximum suppression: keep corners (strongest first) that are at
+    least min_distance away from every corner kept before them.
+
+    Returns the indices of the kept corners, strongest first.
+    """
+    order = onp.argsort(-scores, kind="stable")
+    kept = []
+    for k in order:
+        if kept:
+            d = onp.linalg.norm(corners[kept] - corners[k], axis=-1)
+            if (d < min_distance).any():
+                continue
+        kept.append(k)
+    return onp.array(kept, dtype=int)
+
+
+class GridDetector:
+    """
+    Shi-Tomasi corners detected independently in a rows x cols grid.
+
+    Every cell gets a quota of ceil(max_corners / cells) corners, so textured
+    regions can't take all of them. Corners closer than `min_distance` across
+    cell borders are suppressed and the strongest `max_corners` are returned.
+    """
+
+    def __init__(self,
+                 rows=4,
+                 cols=8,
+                 quality_level=0.1,
+                 min_distance=50,
+                 workers=4):
+        self.rows = rows
+        self.cols = cols
+        self.quality_level = quality_level
+        self.min_distance = min_distance
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="detect")
+
+    def _cells(self, shape):
+        h, w = shape
+        ys = onp.linspace(0, h, self.rows + 1).astype(int)
+        xs = onp.linspace(0, w, self.cols + 1).astype(int)
+        return [(ys[r], ys[r + 1], xs[c], xs[c + 1]) for r in range(self.rows)
+                for c in range(self.cols)]
+
+    def _detect_cell(self, img, mask, cell, quota):
+        y0, y1, x0, x1 = cell
+        cell_mask = None if mask is None else mask[y0:y1, x0:x1]
+        if cell_mask is not None and not cell_mask.any():
+            return onp.zeros((0, 2)), onp.zeros(0)
+
+        corners, scores = cv2.goodFeaturesToTrackWithQuality(
+            img[y0:y1, x0:x1], quota, self.quality_level, self.min_distance,
+            cell_mask)
+        if corners is None or not len(corners):
+            return onp.zeros((0, 2)), onp.zeros(0)
+        return corners.reshape((-1, 2)) + (x0, y0), scores.ravel()
+
+    def detect(self, img, max_corners, mask=None):
+        """
+        Up to max_corners corners (M, 2) as integer (x, y) pixels, strongest
+        first, and their Shi-Tomasi scores (M,). Pixels where `mask` is 0 are
+        skipped.
+        """
+        if max_corners <= 0:
+            return onp.zeros((0, 2), dtype=int), onp.zeros(0)
+
+        cells = self._cells(img.shape)
+        quota = math.ceil(max_corners / len(cells))
+        results = list(
+            self._pool.map(
+                lambda cell: self._detect_cell(img, mask, cell, quota), cells))
+
+        corners = onp.concatenate([c for c, _ in results])
+        scores = onp.concatenate([s for _, s in results])
+        if not len(corners):
+            return onp.zeros((0, 2), dtype=int), onp.zeros(0)
+
+        kept = _suppress(corners, scores, self.min_distance)[:max_corners]
+        return corners[kept].astype(int), scores[kept]
+
+    def close(self):
+        self._pool.shutdown(wait=False)
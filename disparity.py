@@ -0,0 +1,180 @@
+# Disparity map cache
+# A full-frame StereoSGBM pass is the most expensive part of a discovery frame,
+# and discovery frames are known in advance (every `discover_freq` frames).
+# `DisparityService` computes their maps ahead of time on a background thread
+# (OpenCV releases the GIL) into an on-disk `DisparityCache` keyed by the
+# stereo pair and the SGBM parameters, so repeated runs (e.g. sweeps) never run
+# SGBM for the same frames again. Maps are stored as .npy files, read back
+# memory-mapped, and the least recently used ones are evicted past a size
+# budget.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as onp
+
+from loader import _imread
+
+
+def _compute(stereo, left, right):
+    # Pixel disparities (SGBM returns fixed point with 4 fractional bits, so
+    # float32 holds them exactly)
+    return (stereo.compute(left, right) / 16.0).astype(onp.float32)
+
+
+class DisparityCache:
+    """
+    Disparity maps in `root`, one <key>.npy per stereo pair and set of
+    StereoSGBM parameters `params`.
+
+    The key covers the image paths, sizes and modification times, so a
+    changed image is a miss. Reading a map touches its file, and once the
+    cache grows past `max_bytes` the files touched longest ago are deleted.
+    """
+
+    def __init__(self, root, params, max_bytes=2**30):
+        self.root = Path(root).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.params = dict(params)
+        self.max_bytes = max_bytes
+        self._tag = json.dumps(self.params, sort_keys=True)
+
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, left_path, right_path):
+        stats = [(str(p), os.stat(p).st_size, os.stat(p).st_mtime_ns)
+                 for p in (left_path, right_path)]
+        key = hashlib.sha1(f"{self._tag}{stats}".encode()).hexdigest()
+        return self.root / f"{key}.npy"
+
+    def get(self, left_path, right_path):
+        """
+        Memory-mapped disparity map of the pair, None if not cached.
+        """
+        path = self._path(left_path, right_path)
+        try:
+            disparity = onp.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # Most recently used
+        os.utime(path)
+        self.hits += 1
+        return disparity
+
+    def put(self, left_path, right_path, disparity):
+        path = self._path(left_path, right_path)
+        # Write to a temporary file first, so that readers (other threads or
+        # runs) never see a partial map
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            onp.save(f, disparity)
+        os.replace(tmp, path)
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        files = []
+        for p in self.root.glob("*.npy"):
+            try:
+                files.append((p.stat().st_mtime, p.stat().st_size, p))
+            except FileNotFoundError:
+                # Evicted by another run
+                continue
+        total = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            p.unlink(missing_ok=True)
+            total -= size
+
+    @property
+    def nbytes(self):
+        return sum(p.stat().st_size for p in self.root.glob("*.npy"))
+
+
+class DisparityService:
+    """
+    Disparity maps for stereo pairs (by image path), from `cache` or computed
+    with StereoSGBM(**params).
+
+    `prefetch` queues pairs for a background worker; `get` returns a pair's
+    map, waiting for the worker if it is already computing it. `computed`
+    counts SGBM runs, `waits` / `wait_time` the times (seconds) `get` had to
+    wait for the worker.
+    """
+
+    def __init__(self, cache, params, workers=1):
+        self.cache = cache
+        self.params = dict(params)
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="disparity")
+        self._futures = {}
+        # StereoSGBM objects are not shared between threads
+        self._local = threading.local()
+
+        self.computed = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _stereo(self):
+        if not hasattr(self._local, "stereo"):
+            self._local.stereo = cv2.StereoSGBM_create(**self.params)
+        return self._local.stereo
+
+    def _load_or_compute(self, left_path, right_path, left=None, right=None):
+        disparity = self.cache.get(left_path, right_path)
+        if disparity is not None:
+            return disparity
+        if left is None:
+            left, right = _imread(left_path), _imread(right_path)
+        disparity = _compute(self._stereo(), left, right)
+        self.computed += 1
+        self.cache.put(left_path, right_path, disparity)
+        return disparity
+
+    def prefetch(self, pairs):
+        """
+        Queue (left_path, right_path) pairs, in order, for the background
+        worker. Queued pairs that are no longer among `pairs` (frames the
+        caller has moved past, e.g. postponed or skipped discoveries) are
+        cancelled, or just forgotten if already running (their map still
+        lands in the cache).
+        """
+        pairs = list(pairs)
+        for pair in set(self._futures) - set(pairs):
+            self._futures.pop(pair).cancel()
+        for pair in pairs:
+            if pair not in self._futures:
+                self._futures[pair] = self._pool.submit(
+                    self._load_or_compute, *pair)
+
+    def get(self, left_path, right_path, left=None, right=None):
+        """
+        Disparity map (H, W) of the pair. Pairs that were queued but not
+        started yet are computed right away from the decoded `left` / `right`
+        images (if given).
+        """
+        future = self._futures.pop((left_path, right_path), None)
+        if future is not None and not future.cancel():
+            if not future.done():
+                self.waits += 1
+                t0 = time.perf_counter()
+                disparity = future.result()
+                self.wait_time += time.perf_counter() - t0
+                return disparity
+            return future.result()
+        return self._load_or_compute(left_path, right_path, left, right)
+
+    def close(self):
+        # Let a running computation finish its write
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._futures.clear()
@@ -1,428 +1,137 @@
-from pathlib import Path
+import os
+import sys
+import time
 
-import cv2
 import jax
 import jax.numpy as jnp
-import matplotlib.pyplot as plt
 import numpy as onp
-import pandas as pd
-from IPython import embed
-from jaxlie import SO3
-from mpl_toolkits import mplot3d
 
-import calib
-from q import _from_axis_angle, _from_wxyz, _rotate, _from_vector
-
-# Show plots
+from dataset import KittiSequence
+from engine import (_add_landmarks, _init_filter, _kalman_gain,
+                    _kalman_update, _mask_missed, _predict_sigma,
+                    _restore_landmarks)
+from evaluate import TrajectoryEvaluator
+from frontend import FrontEnd
+from instrument import Profiler
+from loader import BackgroundIterator
+from mapping import LandmarkMap
+from precision import _dtypes
+from recorder import TrajectoryRecorder
+from scheduler import DeadlineScheduler
+from model import (_A_pose, _C_structured, _check_jacobians, _f, _g,
+                   _normalize_q)
+
+# Show plots. When off (headless), matplotlib is never imported and no figures
+# are created
 show = False
-# Triangulate new features every `discover_freq` frames
+# Stop at the IPython breakpoints. IPython is only imported once one is hit
+interactive = True
+# Per-frame debug prints (these block on the device every frame, so turn them
+# off when timing)
+verbose = True
+# Every `discover_freq` frames, retire tracks lost for `max_misses` frames and
+# triangulate new features into the free slots (up to `target_features`, all
+# slots when None)
 discover_features = True
 discover_freq = 10
-
-
-def _load_text(p):
-    with open(p, "r") as f:
-        return [x.strip() for x in f.readlines()]
-
-
-def _load_image(p):
-    img = cv2.imread(str(data_path / p), cv2.IMREAD_GRAYSCALE)
-    # img = onp.float32(img) / 255
-    return img
-
-
-poses_path = "/media/bryan/shared/kitti2/dataset/poses/00.txt"
-poses = []
-for l in _load_text(poses_path):
-    poses.append(jnp.array([float(x) for x in l.split(" ")]).reshape((3, 4)))
-poses = jnp.array(poses)
-print(f"{poses.shape = }")
-gt_positions = jnp.array([x[:, -1] for x in poses])
-
-data_path = Path("/media/bryan/shared/kitti2/dataset/sequences/00")
-calib_path = data_path / "calib.txt"
-times_path = data_path / "times.txt"
-
-left_img_paths = _load_text(data_path / "left_imgs.txt")
-left_img_paths = [data_path / "image_0" / x for x in left_img_paths]
-
-right_img_paths = _load_text(data_path / "right_imgs.txt")
-right_img_paths = [data_path / "image_1" / x for x in right_img_paths]
-times = _load_text(times_path)  # In seconds
-times = [float(x) for x in times]
-
-num_imgs = len(left_img_paths)
-assert len(left_img_paths) == len(right_img_paths)
-assert len(left_img_paths) == len(times)
-
-left_path = left_img_paths[0]
-right_path = right_img_paths[0]
-
-left = _load_image(left_path)
-right = _load_image(right_path)
-
-# embed()
-
-fig, axs = plt.subplots(nrows=1, ncols=2)
-axs[0].imshow(left)
-axs[0].set_title("left")
-axs[1].imshow(right)
-axs[1].set_title("right")
-if show:
-    plt.show()
-
-# Extract disparity
-window_size = 5
-min_disp = 0
-num_disp = 64
-
-stereo = cv2.StereoSGBM_create(minDisparity=min_disp,
-                               numDisparities=num_disp,
-                               blockSize=16,
-                               P1=8 * 3 * window_size**2,
-                               P2=8 * 3 * window_size**2,
-                               disp12MaxDiff=1,
-                               uniquenessRatio=10,
-                               speckleWindowSize=100,
-                               speckleRange=32)
-
-# Convert to pixel-level disparity
-disparity = stereo.compute(left, right) / 16.0
-
-plt.figure()
-plt.title("initial disparity")
-plt.imshow(disparity)
-
-if show:
-    plt.show()
-
-# Verify results
-x = 800
-y = 300
-fig, axs = plt.subplots(nrows=1, ncols=2)
-axs[0].imshow(left)
-axs[0].set_title("left")
-axs[0].scatter(x, y, c='r')
-
-axs[1].imshow(right)
-axs[1].set_title("right")
-axs[1].scatter(x, y, c='c', label="original")
-axs[1].scatter(x - disparity[y, x], y, c='r', label="adjusted")
-plt.legend()
-if show:
-    plt.show()
-
-# embed()
-
-# Find point features
-corners = cv2.goodFeaturesToTrack(left,
-                                  maxCorners=10,
-                                  qualityLevel=0.1,
-                                  minDistance=50)
-corners = onp.squeeze(corners).astype(int)
-
-disparity_corners = disparity[corners[:, 1], corners[:, 0]]
-
-# embed()
-valid = disparity_corners > 10
-disparity_corners = disparity_corners[valid]
-corners = corners[valid]
-
-fig, axs = plt.subplots(nrows=1, ncols=2)
-axs[0].imshow(left)
-axs[0].set_title("corners on left")
-axs[0].scatter(corners[:, 0], corners[:, 1], c='r')
-
-axs[1].imshow(right)
-axs[1].set_title("corners on right")
-axs[1].scatter(corners[:, 0], corners[:, 1], c='c', label="original")
-axs[1].scatter(corners[:, 0] - disparity_corners,
-               corners[:, 1],
-               c='r',
-               label="adjusted")
-plt.legend()
-if show:
-    plt.show()
-
-# Back project to 3D for the left camera
-P0, P1 = calib._load_calib(calib_path)
-
-# Calculate depth
-cx = P0[0, 2]
-cy = P0[1, 2]
-fx_px = P0[0, 0]
-fy_px = P0[1, 1]  # fx = fy for KITTI
-baseline_px = P1[0, 3]
-baseline_m = 0.54
-
-z = (fx_px * baseline_m) / disparity_corners
-
-# Camera coordinate system is as follows
-# z pointing into the screen
-# ------> x
-# |
-# |
-# v
-# y
-
-# Calculate x, y coordinates
-bp_x = (corners[:, 0] - cx) * (z / fx_px)
-bp_y = (corners[:, 1] - cy) * (z / fy_px)
-bp_z = z
-
-# Plot backprojection results (2D)
-fig, axs = plt.subplots(nrows=2, ncols=1)
-
-im = axs[0].scatter(corners[:, 0], corners[:, 1], c=bp_z)
-axs[0].invert_yaxis()
-fig.colorbar(im, ax=axs[0])
-axs[0].set_title("x, y")
-axs[0].set_aspect('equal', adjustable='box')
-
-axs[1].scatter(bp_x, bp_y, c=bp_z)
-axs[1].invert_yaxis()
-axs[1].set_title("after back projection")
-axs[1].set_aspect('equal', adjustable='box')
-
-if show:
-    plt.show()
-
-# Plot backprojected result in 3D
-fig = plt.figure()
-ax = plt.axes(projection='3d')
-# ax.set_aspect('equal')
-
-ax.scatter3D(corners[:, 0], corners[:, 1], bp_z, c=bp_z)
-ax.set_xlabel('x')
-ax.set_ylabel('y')
-ax.set_zlabel('z')
-ax.invert_xaxis()
-ax.invert_zaxis()
-ax.set_title("image x, y with depth")
-
-# Set aspect ratio (space out the z-axis to see the depth more clearly)
-ax.set_box_aspect(
-    (onp.ptp(corners[:, 0]), onp.ptp(corners[:, 1]), 5 * onp.ptp(bp_z)))
-
-if show:
-    plt.show()
-
-fig = plt.figure()
-ax = plt.axes(projection='3d')
-ax.scatter3D(bp_x, bp_y, bp_z, c=bp_z)
-ax.set_xlabel('x')
-ax.set_ylabel('y')
-ax.set_zlabel('z')
-ax.invert_xaxis()
-ax.invert_zaxis()
-ax.set_title("backprojected x, y with depth")
-
-# Set aspect ratio (space out the z-axis to see the depth more clearly)
-ax.set_box_aspect(
-    (onp.ptp(corners[:, 0]), onp.ptp(corners[:, 1]), 5 * onp.ptp(bp_z)))
-
-if show:
-    plt.show()
-
-# Observation model (project 3D points down to 2D)
-# 4 x N
-features = onp.vstack((bp_x, bp_y, bp_z, onp.ones(len(bp_x))))
-projected_features = P0 @ features  # 3 x N
-# Normalize by homogenous coordinate
-projected_features = (projected_features / projected_features[-1]).T
-projected_features = round(projected_features[:, :2])
-onp.testing.assert_allclose(corners, projected_features)
-
-plt.figure()
-plt.imshow(left)
-plt.scatter(projected_features[:, 0],
-            projected_features[:, 1],
-            c='r',
-            label="reprojected features")
-plt.legend()
-if show:
-    plt.show()
-
-plt.close('all')
-
-# Do EKF filtering
-
-
-# Manage the state (only robot pose at the start)
-def _split(x):
-    # First 13 elements are the robot pose
-    p = x[:3]
-    q = _from_wxyz(x[3:7])
-    v = x[7:10]
-    w = x[10:13]
-
-    # Rest of elements are the 3D feature locations
-    features = x[13:]
-    features = jnp.reshape(features, (-1, 3))
-    return p, q, v, w, features
-
-
-def _join(p, q, v, w, features):
-    # features.shape = (N, 3)
-    # q: jaxlie.SO3
-
-    return jnp.array([
-        *p,  #
-        *q.wxyz,
-        *v,
-        *w,
-        *features.flatten()
-    ])
-
-
-# Add features to state
-# features.shape = N x 3
-features = features.T[:, :3]
-
-# Same as before, we assume that z-axis goes into the page, y-axis points down, and x-axis points to the right.
-# This satisfies the right-hand rule.
-
-mu0 = _join(
-    # 3D location (xyz)
-    [0, 0, 0],
-    # Rotation (rotation quaternion, we start off as identity = no rotation)
-    SO3.identity(),
-    # Velocity (xyz),
-    [0, 0, 2],
-    # Angular velocity (xyz, rad/s),
-    1e-8 + jnp.array([0, 0, 0]),
-    features)
-
-# Close to 0 process noise for the landmarks (assume stationary)
-Q = jax.scipy.linalg.block_diag(0.1 * jnp.identity(13),
-                                1e-8 * jnp.identity(3 * features.shape[0]))
-R = 1e-3 * jnp.identity(2 * len(features))
-sigma0 = 0.01 * jnp.identity(len(mu0))
-
-mus = [mu0]
-sigmas = [sigma0]
-
-
-# State transition
-@jax.jit
-def _f(x, dt):
-    """
-    Constant velocity motion model. 
-    """
-    p, q, v, w, features = _split(x)
-    _p = p + v * dt
-
-    # Calculate axis-angle representation
-    w_norm = jnp.linalg.norm(w)
-    theta = dt * w_norm
-    _w = jnp.where(w_norm > 1e-8, w / w_norm, w)
-    r = _from_axis_angle(_w, theta)
-
-    # Ensure rotation
-    r = r.normalize()
-
-    # NOTE: the new instataneous rotation comes at the end, not before.
-    _q = q @ r
-    return _join(_p, _q, v, w, features)
-
-
-def _normalize(wxyz):
-    return SO3(wxyz).normalize().wxyz
-
-
-_j_normalize = jax.jit(jax.jacfwd(_normalize))
-
-
-def _normalize_q(x):
-    p, q, v, w, features = _split(x)
-    # Compute normalized quaternion
-    wxyz = q.wxyz
-    _q = _normalize(wxyz)
-    # Compute Jacobian
-    jq = _j_normalize(wxyz)
-    return _join(p, SO3(_q), v, w, features), jq
-
-
-# Observe
-img_w, img_h = (1241, 376)
-
-
-def _plot_orientation(q):
-    fig = plt.figure()
-    ax = plt.axes(projection='3d')
-
-    # Basis vectors
-    xb = _rotate(q, _from_vector([1, 0, 0]))
-    yb = _rotate(q, _from_vector([0, 1, 0]))
-    zb = _rotate(q, _from_vector([0, 0, 1]))
-
-    bs = [xb, yb, zb]
-    bs = [_.wxyz[1:] for _ in bs]
-
-    for x in bs:
-        ax.plot([0, x[0]], [0, x[1]], [0, x[2]])
-
-    ax.set_xlabel('x')
-    ax.set_ylabel('y')
-    ax.set_zlabel('z')
-    plt.show()
-
-
-def _g(x):
+max_misses = 3
+target_features = None
+# Number of landmark slots in the state (upper bound on tracked corners)
+max_features = 10
+# Corners are detected per cell of a rows x cols grid (so they spread over the
+# frame), at least `min_distance` pixels apart
+detect_grid = (4, 8)
+min_distance = 50
+# Compare the closed-form Jacobians against autodiff on the first frame
+check_jacobians = False
+# Match stereo only at the detected corners instead of running StereoSGBM over
+# the whole frame
+sparse_stereo = True
+# Cache full StereoSGBM maps (needed without sparse_stereo, or for plots) in
+# this directory, computed ahead for discovery frames on a background thread
+# and reused across runs (see disparity.py). None to always compute them
+disparity_cache = None
+disparity_cache_bytes = 2**30
+# Reject optical flow tracks whose forward-backward error exceeds this (pixels)
+fb_threshold = 1.0
+# Number of stereo pairs to decode ahead of the filter
+prefetch_depth = 4
+# Run the front end (tracking, detection, stereo) on its own thread, up to
+# `pipeline_depth` frames ahead of the filter
+pipeline = False
+pipeline_depth = 2
+# Real-time replay (see scheduler.py): pace frames by their timestamps (sped up
+# by `realtime_speed`) with a deadline per frame (one frame period when None).
+# When behind, frames are skipped (prediction only), discovery is postponed (at
+# most `max_postpone` frames) and, after a deadline miss, capped to
+# `cap_features` landmarks
+realtime = False
+realtime_speed = 1.0
+deadline = None
+max_postpone = 10
+cap_features = None
+# Keep retired landmarks in a map (see mapping.py) and re-activate the ones
+# that come back into view at discovery frames before triangulating new ones.
+# Map landmarks are found up to `map_max_depth` m away (in `map_voxel_size` m
+# voxels) and matched when their patch correlates by at least `map_min_ncc`.
+# Not with `pipeline`: reactivation reads the filter's latest pose
+landmark_map = False
+map_voxel_size = 5.0
+map_max_depth = 50.0
+map_min_ncc = 0.8
+# Trajectory error against ground truth (see evaluate.py), updated as frames
+# come in: KITTI relative pose error over `rpe_lengths` m from every
+# `rpe_step`-th frame
+rpe_lengths = (100, 200, 300, 400, 500, 600, 700, 800)
+rpe_step = 10
+# Time each stage of the loop and write profile.csv / profile.json
+profile = False
+# Per-frame fields to keep (see recorder.py) and, optionally, how often to
+# write the full state / covariance to <out_dir>/snapshots_*.npy
+record_fields = ("pose", "velocity", "pose_cov")
+snapshot_every = None
+
+# Numeric precision: "float32", "float64" or "mixed" (float32 storage and
+# Jacobians, float64 gain / covariance update), see precision.py. Pure float32
+# diverges on longer runs with the default noise settings
+precision = "mixed"
+# Covariance repair after each update: "symmetric", "psd" or None
+repair = "symmetric"
+
+# Filter noise (see sweep.py for tuning these)
+# Process noise of the pose (13) and landmark (3N) parts of the state
+q_pose = 0.1
+q_landmark = 1e-8
+# Measurement noise (pixels^2)
+r_pixel = 1e-3
+# Initial covariance scale
+sigma0_scale = 0.01
+# Pixel variance of stereo matches (corner location and disparity) when
+# initializing new landmarks
+r_stereo = 1.0
+# Initial velocity (m/s, camera frame)
+v0 = [0, 0, 2]
+
+dataset_root = "/media/bryan/shared/kitti2/dataset"
+
+
+def embed():
     """
-    Observation model.
-
-    Project each 3D feature to 2D plane based on estimated pose.
+    IPython breakpoint in the caller's namespace (no-op unless interactive).
     """
-    p, q, v, w, features = _split(x)
-
-    # Transform from world to view/camera space
-    R_ = q.inverse().as_matrix()
-
-    def l(xyz):
-        # p.shape = (3,)
-        # return xyz
-        # return xyz - p
-        return R_ @ (xyz - p)
-
-    features = jax.vmap(l)(features)
-    # embed()
-
-    # Append homogenous coordinates
-    features = jnp.hstack((features, jnp.ones((len(features), 1))))
-    projected_features = P0 @ features.T
-    projected_features = (projected_features / projected_features[-1]).T
-    # Clip features to correct range
-    final = jnp.array([
-        jnp.clip(projected_features[:, 0], a_min=0, a_max=img_w),
-        jnp.clip(projected_features[:, 1], a_min=0, a_max=img_h)
-    ]).T
-    # final = projected_features[:, :2]
-    return final.flatten()
+    if not interactive:
+        return
+    from IPython.terminal.embed import InteractiveShellEmbed
+    caller = sys._getframe(1)
+    InteractiveShellEmbed.instance()(local_ns=caller.f_locals,
+                                     module=sys.modules.get(
+                                         caller.f_globals["__name__"]))
 
 
 def _range(x):
     (jnp.min(x), jnp.max(x))
 
 
-# Set up optical flow tracking
-old_left = left
-p0 = corners
-lk_params = dict(
-    winSize=(15, 15),
-    maxLevel=2,
-    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03),
-)
-
-_A = jax.jit(jax.jacfwd(_f))
-_C = jax.jit(jax.jacfwd(_g))
-
-# n = state dimension
-n = len(mu0)
-
-measure_errors = []
-
-
 def _predict():
     pass
 
@@ -431,247 +140,376 @@ def _update():
     pass
 
 
-def _update_mu(_mu, K, inno):
-    add_term = K @ inno
-    return _mu + add_term
-
-    # Modified quaternion update
-    mu = _mu + add_term
+def run(seq="00", root=dataset_root, num_frames=30, out_dir="."):
+    """
+    Run the stereo EKF on the first `num_frames` frames of a KITTI sequence
+    (the whole sequence when None).
+
+    Configuration is read from the module-level settings above. Returns the
+    trajectory recorder, timestamps, ground truth positions (None for test
+    sequences), reprojection errors, per-frame latencies (s), the real-time
+    scheduler (None unless `realtime`), the trajectory error (ATE / RPE, None
+    without ground truth) and the profiler.
+    """
+    storage, accumulate = _dtypes(precision)
+    # Map reactivation predicts the pose from the latest posterior, which a
+    # front end running ahead on its own thread would read mid-update
+    assert not (pipeline and landmark_map), \
+        "landmark_map needs the front end in lockstep, turn off pipeline"
+
+    sequence = KittiSequence(root, seq)
+    poses = sequence.poses
+    if poses is not None:
+        print(f"{poses.shape = }")
+    gt_positions = sequence.gt_positions
+    times = sequence.times  # In seconds
+
+    prof = Profiler(enabled=profile)
+    stop = len(times) if num_frames is None else min(num_frames, len(times))
+    scheduler = None
+    if realtime:
+        scheduler = DeadlineScheduler(times[:stop],
+                                      speed=realtime_speed,
+                                      deadline=deadline,
+                                      max_postpone=max_postpone,
+                                      cap_features=cap_features)
+    lmap = None
+    if landmark_map:
+        lmap = LandmarkMap(sequence.camera,
+                           voxel_size=map_voxel_size,
+                           max_depth=map_max_depth,
+                           min_ncc=map_min_ncc,
+                           min_distance=min_distance)
+    frontend = FrontEnd(sequence,
+                        num_frames=num_frames,
+                        max_features=max_features,
+                        target_features=target_features,
+                        max_misses=max_misses,
+                        discover_freq=discover_freq,
+                        discover_features=discover_features,
+                        sparse_stereo=sparse_stereo,
+                        prefetch_depth=prefetch_depth,
+                        keep_disparity=show,
+                        fb_threshold=fb_threshold,
+                        grid=detect_grid,
+                        min_distance=min_distance,
+                        scheduler=scheduler,
+                        disparity_cache=disparity_cache,
+                        disparity_cache_bytes=disparity_cache_bytes,
+                        landmark_map=lmap,
+                        prof=prof)
+
+    # Detect corners and triangulate them with stereo
+    frame = frontend.first()
+    left, right = frame.left, frame.right
+    corners = frame.corners
+    disparity = frame.disparity
 
-    # Don't add quaternions, rotate existing orientation by new quaternion
-    q = SO3(_mu[3:7])
-    new_q = q @ SO3.exp(add_term[3:6]).normalize()
     # embed()
-    mu = mu.at[3:7].set(new_q.wxyz)
-    return mu
 
+    if show:
+        import plots
+        plots._stereo_pair(left, right)
+        plots._disparity(disparity)
+        # Verify results
+        plots._disparity_check(left, right, disparity)
+        plots._corners(left, right, corners, frame.disparity_corners)
+
+    # Back projected to 3D for the left camera
+    features, active = frame.features, frame.active
+    camera = sequence.camera
+
+    if show:
+        bp_x, bp_y, bp_z = features[active].T
+        plots._backprojection(corners, bp_x, bp_y, bp_z)
+
+    # Observation model (project 3D points down to 2D)
+    projected_features = onp.round(camera.project(features[active]))
+    onp.testing.assert_allclose(corners, projected_features)
+
+    if show:
+        plots._reprojection(left, projected_features)
+
+    # Do EKF filtering
+
+    # Add features to state
+    mu0, sigma0, Q, R = _init_filter(features, v0, q_pose, q_landmark,
+                                     r_pixel, sigma0_scale)
+    mu0, sigma0, Q, R = (x.astype(storage) for x in (mu0, sigma0, Q, R))
+    camera = camera.astype(storage)
+
+    mu, sigma = mu0, sigma0
+    recorder = TrajectoryRecorder(stop,
+                                  fields=record_fields,
+                                  snapshot_every=snapshot_every,
+                                  snapshot_dir=out_dir)
+    recorder.append(0, times[0], mu, sigma)
+    evaluator = None
+    if poses is not None:
+        evaluator = TrajectoryEvaluator(poses[:stop], rpe_lengths, rpe_step)
+        evaluator.append(0, onp.asarray(mu[:7]))
+    if lmap is not None:
+        lmap.set_state(times[0], mu)
+
+    # n = state dimension
+    n = len(mu0)
+
+    measure_errors = []
+    old_left = left
+    if pipeline:
+        # Without a landmark map the front end never reads the filter state,
+        # so it can run ahead
+        frames = BackgroundIterator(frontend, pipeline_depth, name="frontend")
+    else:
+        frames = iter(frontend)
+
+    # Wall-clock seconds per frame, from the end of the previous frame
+    # (including waiting for the front end)
+    latencies = []
+    last = time.perf_counter()
+
+    def _done(frame, mu, sigma):
+        nonlocal last
+        # Recording copies the state to the host, so the frame is done
+        recorder.append(frame.i, frame.t, mu, sigma)
+        prof.track_memory(recorder=recorder.frame_nbytes)
+        if evaluator is not None:
+            evaluator.append(frame.i, onp.asarray(mu[:7]))
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+        if scheduler is not None:
+            scheduler.done(frame.i, frame.skipped, frame.new is not None)
+        if lmap is not None:
+            # Pose prediction for the front end's next map query
+            lmap.set_state(frame.t, mu)
+
+    if realtime:
+        # Compile the map update (a no-op here) before the clock starts, so
+        # the first discovery doesn't miss its deadline
+        jax.block_until_ready(
+            _add_landmarks(mu, sigma, onp.zeros_like(frame.features),
+                           onp.zeros_like(frame.features_cov),
+                           onp.zeros_like(frame.new), frame.active, r_stereo))
+        if lmap is not None:
+            jax.block_until_ready(
+                _restore_landmarks(mu, sigma, frame.landmarks,
+                                   frame.landmarks_cov, frame.reactivated))
+    try:
+        # Iterate through all images (measurements)
+        for frame in (prof.iterate("wait", frames) if pipeline else frames):
+            i, t, left, right = frame.i, frame.t, frame.left, frame.right
+            dt = t - times[i - 1]
+            if verbose:
+                print(f"i = {i}, dt = {dt}")
+            dt = onp.asarray(dt, dtype=storage)
+
+            if check_jacobians and i == 1:
+                _check_jacobians(mu, dt, camera)
+
+            # (1) Predict
+            with prof.stage("predict") as sync:
+                _mu = _f(mu, dt)
+                A = _A_pose(mu, dt)
+                _sigma = _predict_sigma(sigma, A, Q)
+                sync(_mu, _sigma)
+
+            if frame.skipped:
+                # Behind schedule: prediction only, the next frame's dt starts
+                # from this one
+                mu, sigma = _mu, _sigma
+                _done(frame, mu, sigma)
+                continue
+
+            # (2) Update
+
+            # C, _g(_mu) will be computed for all 3D feature locations.
+            # But we might not actually observe all of them in the image due
+            # to camera movement occlusion. The mean should not be touched,
+            # the covariance should increase (update step should not decrease
+            # covariance for unobserved features, just leave them alone).
+
+            # Features tracked by the front end
+            p0, p1, st = frame.p0, frame.p1, frame.st
+            good_new = p1[st == 1]
+            good_old = p0[st == 1]
+            if verbose:
+                print(f"{onp.max(good_new, initial=0) = }, "
+                      f"{onp.min(good_new, initial=0) = }")
+                print(f"{onp.max(frame.quality[st == 1], initial=0) = }")
 
-def _view_to_world(x, features):
-    """
-    Convert 3D feature locations (M, 3) in view space to world space 
-    given the camera location and position.
-    """
-    p, q, v, w, _ = _split(x)
-    R = q.as_matrix()
-    print(f"{R = }")
-    print(f"{p = }")
-
-    def l(xyz):
-        return R @ xyz + p
-
-    features = jax.vmap(l)(features)
-    return features
-
-
-def _update_features(x, new_features):
-    p, q, v, w, _ = _split(x)
-    new_features = jnp.reshape(new_features, (-1, 3))
-    return _join(p, q, v, w, new_features)
-
-
-try:
-    # Iterate through all images (measurements)
-    for i in range(1, 30):
-        mu = mus[-1]
-        sigma = sigmas[-1]
-        dt = times[i] - times[i - 1]
-        print(f"i = {i}, dt = {dt}")
-
-        # (1) Predict
-        _mu = _f(mu, dt)
-        A = _A(mu, dt)
-        _sigma = A @ sigma @ A.T + Q
-
-        # (2) Update
-
-        # C, _g(_mu) will be computed for all 3D feature locations.
-        # But we might not actually observe all of them in the image due to camera movement
-        # occlusion. The mean should not be touched, the covariance should increase (update step
-        # should not decrease covariance for unobserved features, just leave them alone).
-
-        # Load images
-        left_path = left_img_paths[i]
-        right_path = right_img_paths[i]
-
-        left = _load_image(left_path)
-        right = _load_image(right_path)
-
-        # Track features
-        p0 = p0.astype(onp.float32).reshape((-1, 1, 2))
-        p1, st, err = cv2.calcOpticalFlowPyrLK(
-            old_left,  #
-            left,
-            p0,
-            None,
-            **lk_params)
-        good_new = p1[st == 1]
-        good_old = p0[st == 1]
-        print(f"{jnp.max(good_new) = }, {jnp.min(good_new) = }")
-
-        if show:
-            fig, axs = plt.subplots(nrows=1, ncols=2)
-            axs[0].imshow(old_left)
-            axs[0].scatter(good_old[:, 0], good_old[:, 1], c='r')
-            axs[0].set_title("old t")
-
-            axs[1].imshow(left)
-            axs[1].scatter(good_new[..., 0], good_new[..., 1], c='r')
-            axs[1].set_title(f"t = {times[i]}, i = {i}")
-            plt.show()
-
-        p1 = p1.flatten()
-        st = st.flatten()
-        good = jnp.argwhere(st == 1).flatten()
-        missed = jnp.argwhere(st == 0).flatten()
-
-        _y = _g(_mu)
-
-        # Visualize measured vs observed
-        y = _y.reshape((-1, 2))
-        if show:
-            plt.figure()
-            plt.imshow(left)
-            plt.scatter(y[:, 0][good], y[:, 1][good], c='c', label="projected")
-            plt.scatter(good_new[:, 0],
-                        good_new[:, 1],
-                        c='r',
-                        label="measured")
-            plt.legend()
-            plt.show()
-
-        # embed()
-        print(f"{jnp.max(_y) = }, {jnp.min(_y) = }")
-        C = _C(_mu)
-
-        # Zero out missing observations
-        for ix in missed:
-            j = 2 * ix
-            C = C.at[j:j + 2].set(0)
-
-        # embed()
-
-        # Observability
-        # O = []
-        # for i in jnp.arange(n):
-        #     O.append(C @ jnp.linalg.matrix_power(A, i))
-        # # Resulting matrix has shape (m * n, n) where m is the measurement dimension
-        # O = jnp.vstack(O)
-        # # Observable if O is full rank
-        # observable = jnp.linalg.matrix_rank(O) == n
-        # # embed()
-        # _O.append(observable)
-
-        K = _sigma @ C.T @ jnp.linalg.inv(C @ _sigma @ C.T + R)
-        if i > 10:
-            embed()
-
-        inno = p1 - _y
-        inno = inno.reshape((-1, 2)).at[missed].set(0)
-        inno = inno.flatten()
-        print(f"{jnp.max(inno) = }, {jnp.min(inno) = }")
-
-        z_sigma = _sigma
-
-        # TODO: vectorize this
-        for ix in missed:
-            j = 13 + 3 * ix
-            z_sigma = z_sigma.at[j:j + 3].set(0)
-            z_sigma = z_sigma.at[:, j:j + 3].set(0)
-
-        mu = _update_mu(_mu, K, inno)
-        sigma = _sigma - K @ C @ z_sigma
-
-        # Check measurement error
-        measure_errors.append(jnp.linalg.norm(_g(mu) - p1))
-
-        # Post-update processing
-        # Normalize quaternion and set covariance accordingly
-        # if i == 8:
-        #     embed()
-        mu, jq = _normalize_q(mu)
-        sigma = sigma.at[3:7, 3:7].set(jq)
-
-        # Update feature tracking
-        old_left = left
-        p0 = p1.reshape((-1, 1, 2))
-
-        if i % discover_freq == 0 and discover_features:
-            # Do the dumb thing - triangulate new 3D features with stereo
-            # Get world space positions based on current camera position + rotation
-            # Replace all features with the new ones - retain constant amount of features
-
-            # NOTE: number of features found may be <= maxCorners, no guarantee
-            corners = cv2.goodFeaturesToTrack(left,
-                                              maxCorners=10,
-                                              qualityLevel=0.1,
-                                              minDistance=50)
-            corners = onp.squeeze(corners).astype(int)
-            disparity = stereo.compute(left, right) / 16.0
-            disparity_corners = disparity[corners[:, 1], corners[:, 0]]
-
-            # Filter out certain points
-            valid = disparity_corners > 10
-            disparity_corners = disparity_corners[valid]
-            corners = corners[valid]
+            if show:
+                plots._tracks(old_left, left, good_old, good_new,
+                              f"t = {times[i]}, i = {i}")
+
+            p1 = p1.flatten()
+            observed = st == 1
+            good = onp.flatnonzero(observed)
 
+            with prof.stage("project") as sync:
+                _y = _g(_mu, camera)
+                sync(_y)
+
+            # Visualize measured vs observed
+            y = _y.reshape((-1, 2))
             if show:
-                fig, axs = plt.subplots(nrows=2, ncols=2)
-                axs[0, 0].imshow(left)
-                axs[0, 0].set_title(f"frame {i}, corners on left")
-                axs[0, 0].scatter(corners[:, 0], corners[:, 1], c='r')
-
-                axs[0, 1].imshow(right)
-                axs[0, 1].set_title(f"frame {i}, corners on right")
-                axs[0, 1].scatter(corners[:, 0],
-                                  corners[:, 1],
-                                  c='c',
-                                  label="original")
-                axs[0, 1].scatter(corners[:, 0] - disparity_corners,
-                                  corners[:, 1],
-                                  c='r',
-                                  label="adjusted")
-
-                axs[1, 0].imshow(disparity)
-                axs[1, 0].set_title("disparity")
-
-            # Backproject to 3D
-            z = (fx_px * baseline_m) / disparity_corners
-            bp_x = (corners[:, 0] - cx) * (z / fx_px)
-            bp_y = (corners[:, 1] - cy) * (z / fy_px)
-            bp_z = z
-
-            features = onp.vstack((bp_x, bp_y, bp_z)).T
-
-            # Convert from view space to world space
-            features_world = _view_to_world(mu, features)
-            old_mu = mu
-            mu = _update_features(mu, features_world)
-            _projected = _g(mu)
-            _projected = jnp.reshape(_projected, (-1, 2))
-
-            # Check that the new features project down to our original corners
-            onp.testing.assert_allclose(corners, round(_projected))
-
-            # Assign as previous features for optical flow
-            p0 = corners
-
-            # Update shapes for KF
-            num_features = len(features)  # Number of new features
-            Q = jax.scipy.linalg.block_diag(
-                0.1 * jnp.identity(13), 1e-8 * jnp.identity(3 * num_features))
-            R = 1e-3 * jnp.identity(2 * num_features)
-            sigma = jax.scipy.linalg.block_diag(
-                sigma[:13, :13],  #
-                0.1 * jnp.identity(3 * num_features))
-
-            embed()
-
-        mus.append(mu)
-        sigmas.append(sigma)
-
-    mus = jnp.array(mus)
-except Exception as e:
-    print(e)
+                plots._projected_vs_measured(left, y[good], good_new)
+
+            # embed()
+            if verbose:
+                print(f"{jnp.max(_y) = }, {jnp.min(_y) = }")
+            with prof.stage("jacobian") as sync:
+                C = _C_structured(_mu, camera)
+
+                # Zero out missing observations (lost tracks and empty slots)
+                C, z_sigma, inno = _mask_missed(C, _sigma, p1 - _y, observed)
+                sync(C, z_sigma, inno)
+
+            # embed()
+
+            # Observability
+            # O = []
+            # for i in jnp.arange(n):
+            #     O.append(C @ jnp.linalg.matrix_power(A, i))
+            # # Resulting matrix has shape (m * n, n) where m is the
+            # # measurement dimension
+            # O = jnp.vstack(O)
+            # # Observable if O is full rank
+            # observable = jnp.linalg.matrix_rank(O) == n
+            # # embed()
+            # _O.append(observable)
+
+            with prof.stage("gain") as sync:
+                K = _kalman_gain(_sigma, C, R, accumulate)
+                sync(K)
+            if i > 10:
+                embed()
+
+            if verbose:
+                print(f"{jnp.max(inno) = }, {jnp.min(inno) = }")
+
+            with prof.stage("update") as sync:
+                mu, sigma = _kalman_update(_mu, _sigma, K, C, z_sigma, inno,
+                                           repair)
+                sync(mu, sigma)
+
+            # Check measurement error
+            measure_errors.append(
+                jnp.linalg.norm(
+                    jnp.where(jnp.repeat(observed, 2),
+                              _g(mu, camera) - p1, 0)))
+
+            # Post-update processing
+            # Normalize quaternion and set covariance accordingly
+            # if i == 8:
+            #     embed()
+            with prof.stage("normalize") as sync:
+                mu, jq = _normalize_q(mu)
+                sigma = sigma.at[3:7, 3:7].set(jq)
+                sync(mu, sigma)
+
+            old_left = left
+
+            if frame.new is not None:
+                # The front end retired lost tracks and triangulated new 3D
+                # features with stereo into the free slots
+                corners = frame.corners
+                new, active = frame.new, frame.active
+                if verbose:
+                    reactivated = (0 if frame.reactivated is None else
+                                   frame.reactivated.sum())
+                    print(f"retired {frame.retired.sum()}, added {new.sum()}, "
+                          f"reactivated {reactivated}, active {active.sum()}")
+
+                if show:
+                    plots._corners(left,
+                                   right,
+                                   corners,
+                                   frame.disparity_corners,
+                                   frame.disparity,
+                                   prefix=f"frame {i}, ")
+
+                # Convert from view space to world space and initialize their
+                # covariance (state size, Q and R are unchanged)
+                if lmap is not None and frame.retired.any():
+                    # Keep the retired landmarks' estimates in the map
+                    k = onp.flatnonzero(frame.retired)
+                    idx = 13 + 3 * k[:, None] + onp.arange(3)  # M x 3
+                    _mu_, _sigma_ = onp.asarray(mu), onp.asarray(sigma)
+                    lmap.insert(_mu_[idx],
+                                _sigma_[idx[:, :, None], idx[:, None, :]],
+                                frame.descriptors[k])
+
+                with prof.stage("triangulate") as sync:
+                    mu, sigma = _add_landmarks(mu, sigma, frame.features,
+                                               frame.features_cov, new, active,
+                                               r_stereo)
+                    if frame.reactivated is not None:
+                        mu, sigma = _restore_landmarks(
+                            mu, sigma, frame.landmarks, frame.landmarks_cov,
+                            frame.reactivated)
+                    sync(mu, sigma)
+                # On the host: eager jnp indexing would compile again for every
+                # new landmark count
+                _projected = onp.asarray(_g(mu, camera)).reshape((-1, 2))
+
+                # Check that the new features project down to our original
+                # corners. Only a warning: once a float32 state has drifted far
+                # from the origin, round-off alone moves the reprojections
+                mismatched = onp.any(corners != onp.round(_projected[new]),
+                                     axis=-1)
+                if mismatched.any():
+                    print(f"frame {i}: {mismatched.sum()}/{len(corners)} new "
+                          f"landmarks don't reproject onto their corners")
+
+                embed()
+
+            _done(frame, mu, sigma)
+
+        prefetcher = frontend.frames
+        print(f"{prefetcher.hits = }, {prefetcher.stalls = }, "
+              f"{prefetcher.stall_time = }")
+        if scheduler is not None:
+            print(f"real time: {scheduler.summary()}")
+        if evaluator is not None:
+            accuracy = evaluator.summary()
+            print(f"ATE {accuracy['ate']:.4f} m, RPE {accuracy['t_err']:.4f} "
+                  f"%, {accuracy['r_err']:.6f} deg/m "
+                  f"({accuracy['segments'].sum()} segments)")
+        if lmap is not None:
+            print(f"map: {len(lmap)} landmarks, {lmap.inserted = }, "
+                  f"{lmap.reactivated = }")
+        disparities = frontend.disparities
+        if disparities is not None:
+            print(f"{disparities.computed = }, {disparities.cache.hits = }, "
+                  f"{disparities.waits = }, {disparities.wait_time = }")
+        if pipeline:
+            print(f"{frames.hits = }, {frames.stalls = }, "
+                  f"{frames.stall_time = }, {frames.blocked_time = }")
+        if profile:
+            print(prof.summary())
+            prof.to_csv(os.path.join(out_dir, "profile.csv"))
+            prof.memory_to_csv(os.path.join(out_dir, "profile_memory.csv"))
+            prof.to_chrome_trace(os.path.join(out_dir, "profile.json"))
+    except Exception as e:
+        print(e)
+        if not interactive:
+            raise
+        embed()
+    finally:
+        frames.close()
+        recorder.close()
+
+    return dict(recorder=recorder,
+                times=recorder["times"],
+                gt_positions=gt_positions,
+                measure_errors=measure_errors,
+                latencies=onp.array(latencies),
+                scheduler=scheduler,
+                accuracy=evaluator and evaluator.summary(),
+                prof=prof)
+
+
+if __name__ == "__main__":
+    result = run()
     embed()
-
-embed()
@@ -0,0 +1,280 @@
+# Whole-chunk EKF engine
+# Runs predict + update for a chunk of pre-tracked frames as a single compiled
+# `jax.lax.scan`, so there is one dispatch (and no host syncs) per chunk
+# instead of a dozen per frame.
+
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+
+from jaxlie import SO3
+
+from model import (_A_pose, _C_structured, _f, _g, _join, _landmark_init,
+                   _normalize_q, _split, _update_mu)
+from precision import _repair
+
+
+def _init_filter(features, v0, q_pose, q_landmark, r_pixel, sigma0_scale):
+    """
+    Initial mean/covariance and noise for landmark slots `features` (N, 3)
+    triangulated in the first (identity) camera frame.
+
+    Returns mu0, sigma0, Q, R.
+    """
+    # Same as before, we assume that z-axis goes into the page, y-axis points
+    # down, and x-axis points to the right. This satisfies the right-hand rule.
+    mu0 = _join(
+        # 3D location (xyz)
+        [0, 0, 0],
+        # Rotation (rotation quaternion, we start off as identity = no
+        # rotation)
+        SO3.identity(),
+        # Velocity (xyz),
+        v0,
+        # Angular velocity (xyz, rad/s),
+        1e-8 + jnp.array([0, 0, 0]),
+        features)
+
+    # Close to 0 process noise for the landmarks (assume stationary)
+    Q = jax.scipy.linalg.block_diag(
+        q_pose * jnp.identity(13),
+        q_landmark * jnp.identity(3 * features.shape[0]))
+    R = r_pixel * jnp.identity(2 * len(features))
+    sigma0 = sigma0_scale * jnp.identity(len(mu0))
+    return mu0, sigma0, Q, R
+
+
+@jax.jit
+def _predict_sigma(sigma, A_pose, Q):
+    """
+    Covariance prediction A @ sigma @ A.T + Q for A = blockdiag(A_pose, I).
+
+    Only the pose rows and columns change, so this is O(n) work (plus the
+    O(n^2) add of Q) instead of the dense O(n^3) product. The landmark block is
+    left in place.
+    """
+    # Pose rows: [A_pp @ S_pp, A_pp @ S_pl]
+    sigma = sigma.at[:13].set(A_pose @ sigma[:13])
+    # Pose columns: A_pp @ S_pp @ A_pp.T on top, S_lp @ A_pp.T below
+    sigma = sigma.at[:, :13].set(sigma[:, :13] @ A_pose.T)
+    return sigma + Q
+
+
+def _mask_missed(C, _sigma, inno, observed):
+    """
+    Mask out features that were not observed this frame
+    (observed.shape = (N,)), either because tracking lost them or because
+    their landmark slot is empty.
+
+    Equivalent to zeroing the rows of C / entries of the innovation and the
+    rows + columns of the covariance for every missed feature, but done with a
+    single `jnp.where` each.
+    """
+    m2 = jnp.repeat(observed, 2)
+    m3 = jnp.concatenate((jnp.ones(13, dtype=bool), jnp.repeat(observed, 3)))
+
+    C = jnp.where(m2[:, None], C, 0)
+    inno = jnp.where(m2, inno, 0)
+    z_sigma = jnp.where(m3[:, None] & m3[None, :], _sigma, 0)
+    return C, z_sigma, inno
+
+
+@jax.jit
+def _add_landmarks(mu, sigma, features, features_cov, new, active, r_stereo):
+    """
+    Map management after discovery: initialize the `new` slots from
+    view-space `features` (N, 3) and drop every slot that is not `active`
+    (retired tracks, empty slots).
+
+    A new landmark l = R(q) f + p depends on the current pose, so it gets the
+    pose's cross-covariance J_pose @ sigma[:13] (and with other new landmarks
+    J_k @ sigma_pp @ J_j.T) plus the stereo noise R @ (r_stereo * features_cov)
+    @ R.T. Landmarks that were already tracked keep their mean and covariance.
+    Dropped slots are zeroed out, which takes them out of the filter exactly
+    as removing their rows and columns would, without changing shapes.
+    """
+    n = len(mu)
+    N = len(new)
+    features = features.astype(mu.dtype)
+    features_cov = features_cov.astype(mu.dtype)
+    world, J, R_ = _landmark_init(mu, features)
+
+    p, q, v, w, landmarks = _split(mu)
+    mu = _join(p, q, v, w, jnp.where(new[:, None], world, landmarks))
+
+    # Drop retired and empty slots
+    m3 = jnp.concatenate((jnp.ones(13, dtype=bool), jnp.repeat(active, 3)))
+    sigma = jnp.where(m3[:, None] & m3[None, :], sigma, 0)
+
+    # Cross-covariance of the new landmarks with the rest of the state
+    new3 = jnp.repeat(new, 3)
+    rows = jnp.einsum("kij,jn->kin", J, sigma[:13]).reshape((3 * N, n))
+    sigma = sigma.at[13:].set(jnp.where(new3[:, None], rows, sigma[13:]))
+    cols = jnp.einsum("nj,kij->nki", sigma[:, :13], J).reshape((n, 3 * N))
+    sigma = sigma.at[:, 13:].set(jnp.where(new3[None, :], cols, sigma[:, 13:]))
+
+    # Stereo triangulation noise, rotated into the world frame
+    noise = (r_stereo * R_ @ features_cov @ R_.T).astype(sigma.dtype)
+    noise = jnp.einsum("kij,kl->kilj", noise, jnp.diag(new))
+    sigma = sigma.at[13:, 13:].add(noise.reshape((3 * N, 3 * N)))
+    return mu, sigma
+
+
+@jax.jit
+def _restore_landmarks(mu, sigma, landmarks, landmarks_cov, reactivated):
+    """
+    Put landmarks from the map (see mapping.py) back into the `reactivated`
+    slots: world locations (N, 3) with their map covariance (N, 3, 3).
+
+    Their correlations with the rest of the state were dropped when they were
+    retired, so the slots' rows and columns start out as zero apart from their
+    own covariance block.
+    """
+    N = len(reactivated)
+    landmarks = landmarks.astype(mu.dtype)
+    landmarks_cov = landmarks_cov.astype(sigma.dtype)
+
+    p, q, v, w, old = _split(mu)
+    mu = _join(p, q, v, w, jnp.where(reactivated[:, None], landmarks, old))
+
+    m3 = jnp.concatenate((jnp.zeros(13, dtype=bool), jnp.repeat(reactivated,
+                                                                3)))
+    sigma = jnp.where(m3[:, None] | m3[None, :], 0, sigma)
+    cov = jnp.einsum("kij,kl->kilj", landmarks_cov, jnp.diag(reactivated))
+    sigma = sigma.at[13:, 13:].add(cov.reshape((3 * N, 3 * N)))
+    return mu, sigma
+
+
+@partial(jax.jit, static_argnames=("accumulate", ))
+def _kalman_gain(_sigma, C, R, accumulate=None):
+    """
+    Kalman gain, computed in the `accumulate` dtype (default: _sigma's).
+    """
+    accumulate = accumulate or _sigma.dtype
+    _sigma, C, R = (x.astype(accumulate) for x in (_sigma, C, R))
+    return _sigma @ C.T @ jnp.linalg.inv(C @ _sigma @ C.T + R)
+
+
+@partial(jax.jit, static_argnames=("repair", ))
+def _kalman_update(_mu, _sigma, K, C, z_sigma, inno, repair=None):
+    """
+    Mean and covariance update in K's dtype (see `_kalman_gain`), with the
+    covariance repaired (see precision._repair) and both cast back to the
+    storage dtype of _mu / _sigma.
+    """
+    _mu_, _sigma_, C, z_sigma, inno = (
+        x.astype(K.dtype) for x in (_mu, _sigma, C, z_sigma, inno))
+    mu = _update_mu(_mu_, K, inno)
+    sigma = _repair(_sigma_ - K @ C @ z_sigma, repair)
+    return mu.astype(_mu.dtype), sigma.astype(_sigma.dtype)
+
+
+def _step(Q, R, camera, r_stereo, accumulate, repair, carry, frame):
+    """
+    One predict + update step.
+
+    carry = (mu, sigma), frame = (dt, y, observed, landmarks) where y holds
+    the tracked feature locations (2N,) and observed (N,) is set for active
+    landmark slots that were tracked this frame. landmarks is None when the
+    chunk has no discovery frames, otherwise (discover, features,
+    features_cov, new, active): on frames with `discover` set, the map is
+    updated after the update step (see `_add_landmarks`).
+    """
+    mu, sigma = carry
+    dt, y, observed, landmarks = frame
+
+    # (1) Predict
+    _mu = _f(mu, dt)
+    _sigma = _predict_sigma(sigma, _A_pose(mu, dt), Q)
+
+    # (2) Update
+    _y = _g(_mu, camera)
+    C = _C_structured(_mu, camera)
+    C, z_sigma, inno = _mask_missed(C, _sigma, y - _y, observed)
+
+    K = _kalman_gain(_sigma, C, R, accumulate)
+    mu, sigma = _kalman_update(_mu, _sigma, K, C, z_sigma, inno, repair)
+
+    # Normalize quaternion and set covariance accordingly
+    mu, jq = _normalize_q(mu)
+    sigma = sigma.at[3:7, 3:7].set(jq)
+
+    # Landmarks retired / triangulated by the front end
+    if landmarks is not None:
+        discover, *landmarks = landmarks
+        mu, sigma = jax.lax.cond(discover, _add_landmarks,
+                                 lambda mu, sigma, *_: (mu, sigma), mu, sigma,
+                                 *landmarks, r_stereo)
+    return (mu, sigma), (mu, sigma)
+
+
+@partial(jax.jit, static_argnames=("accumulate", "repair", "sigmas"))
+def _run(mu0,
+         sigma0,
+         Q,
+         R,
+         camera,
+         dts,
+         ys,
+         observed,
+         landmarks=None,
+         r_stereo=1.0,
+         accumulate=None,
+         repair=None,
+         sigmas="full"):
+    """
+    Filter a chunk of T frames with N landmark slots.
+
+    dts.shape = (T,), ys.shape = (T, 2N), observed.shape = (T, N) and, for
+    chunks with landmark discovery, landmarks = (discover (T,),
+    features (T, N, 3), features_cov (T, N, 3, 3), new (T, N), active (T, N))
+    (see `_step`). camera is a calib.StereoCamera.
+
+    The state and covariance are kept in mu0's dtype, the gain and update are
+    accumulated in `accumulate` (see precision.py).
+
+    Returns the stacked means (T, n) and covariances after each frame's
+    update: (T, n, n) with sigmas="full", only the pose block (T, 13, 13)
+    with "pose", and None (nothing stacked) with sigmas=None.
+    """
+    dtype = mu0.dtype
+    Q, R, dts, ys = (x.astype(dtype) for x in (Q, R, dts, ys))
+    camera = camera.astype(dtype)
+    step = partial(_step, Q, R, camera, r_stereo, accumulate, repair)
+
+    def _record(carry, frame):
+        carry, (mu, sigma) = step(carry, frame)
+        if sigmas == "pose":
+            sigma = sigma[:13, :13]
+        elif sigmas is None:
+            sigma = None
+        return carry, (mu, sigma)
+
+    _, (mus, sigmas_) = jax.lax.scan(_record, (mu0, sigma0),
+                                     (dts, ys, observed, landmarks))
+    return mus, sigmas_
+
+
+@partial(jax.jit, static_argnames=("accumulate", "repair", "sigmas"))
+def _run_batched(mu0,
+                 sigma0,
+                 Q,
+                 R,
+                 camera,
+                 dts,
+                 ys,
+                 observed,
+                 landmarks=None,
+                 r_stereo=1.0,
+                 accumulate=None,
+                 repair=None,
+                 sigmas="full"):
+    """
+    Independent filters with their own initial state / noise (leading axis B)
+    over the same measurements, e.g. for parameter sweeps (see sweep.py).
+    """
+    run = partial(_run, accumulate=accumulate, repair=repair, sigmas=sigmas)
+    return jax.vmap(run, in_axes=(0, 0, 0, 0, None, None, None, None, None,
+                                  0))(mu0, sigma0, Q, R, camera, dts, ys,
+                                      observed, landmarks, r_stereo)
@@ -0,0 +1,297 @@
+# Trajectory evaluation against ground truth
+# Absolute trajectory error (ATE): position RMSE after aligning the estimate
+# to the ground truth with the best rigid (or similarity) transform (Umeyama,
+# 1991). Relative pose error (RPE) as in the KITTI odometry devkit: for
+# segments starting every `step` frames, the error of the estimated motion
+# over the first 100, 200, ..., 800 m traveled (ground truth distance), as
+# translation (%) and rotation (deg/m) per meter.
+#
+# Both come in two forms:
+#   - batched (`ate`, `rpe`, `evaluate`) over trajectories (..., T, ...), e.g.
+#     all configurations of a sweep at once. The segments only depend on the
+#     ground truth, so they are found once and shared by the whole batch.
+#   - streaming (`TrajectoryEvaluator`), updated in O(1) per frame as poses
+#     arrive: the ATE alignment only needs running sums of the positions, and
+#     a segment is scored as soon as its last frame is in.
+#
+#   python evaluate.py results/00/trajectory.npy --seq 00
+
+import argparse
+
+import numpy as onp
+
+from q import _as_matrix_host
+
+# KITTI segment lengths (m)
+_lengths = (100, 200, 300, 400, 500, 600, 700, 800)
+
+
+def _homogeneous(poses):
+    """
+    (..., 4, 4) transforms from (..., 7) position + wxyz poses (see
+    recorder.py) or (..., 3, 4) [R | p] poses (KITTI poses.txt).
+    """
+    poses = onp.asarray(poses, dtype=float)
+    if poses.shape[-1] == 7:
+        R = _as_matrix_host(poses[..., 3:])
+        p = poses[..., :3]
+    else:
+        R, p = poses[..., :3, :3], poses[..., :3, 3]
+    T = onp.zeros((*R.shape[:-2], 4, 4))
+    T[..., :3, :3] = R
+    T[..., :3, 3] = p
+    T[..., 3, 3] = 1
+    return T
+
+
+def _inv(T):
+    # Inverse of rigid transforms (..., 4, 4)
+    R, p = T[..., :3, :3], T[..., :3, 3]
+    inv = onp.zeros_like(T)
+    inv[..., :3, :3] = onp.swapaxes(R, -1, -2)
+    inv[..., :3, 3] = -onp.einsum("...ji,...j->...i", R, p)
+    inv[..., 3, 3] = 1
+    return inv
+
+
+def _sums(x, y):
+    """
+    Sufficient statistics of point pairs x, y (..., T, 3) for the alignment:
+    (n, sum x, sum y, sum y x^T, sum |x|^2, sum |y|^2).
+    """
+    x, y = onp.broadcast_arrays(x, y)
+    return (x.shape[-2], x.sum(axis=-2), y.sum(axis=-2),
+            onp.einsum("...ti,...tj->...ij", y, x), (x**2).sum(axis=(-2, -1)),
+            (y**2).sum(axis=(-2, -1)))
+
+
+def _umeyama(sums, align="se3"):
+    """
+    Transform (R, t, s) minimizing mean |y - (s R x + t)|^2 over the pairs
+    summarized by `sums` (see `_sums`), and the RMSE it leaves. align is
+    "se3" (s = 1), "sim3" (s free) or None (no alignment).
+
+    Trajectories with non-finite positions (diverged filters) get NaN.
+    """
+    n, sx, sy, syx, sxx, syy = sums
+    batch = onp.shape(sxx)
+    if align is None:
+        mse = (sxx + syy - 2 * onp.trace(syx, axis1=-2, axis2=-1)) / n
+        R = onp.broadcast_to(onp.identity(3), (*batch, 3, 3))
+        return R, onp.zeros((*batch, 3)), onp.ones(batch), onp.sqrt(
+            onp.maximum(mse, 0))
+
+    mx, my = sx / n, sy / n
+    cov = syx / n - my[..., :, None] * mx[..., None, :]
+    var_x = sxx / n - (mx**2).sum(axis=-1)
+    var_y = syy / n - (my**2).sum(axis=-1)
+
+    # SVD does not converge on NaNs
+    finite = onp.isfinite(cov).all(axis=(-2, -1))
+    U, D, Vt = onp.linalg.svd(onp.where(finite[..., None, None], cov, 0))
+    S = onp.ones((*batch, 3))
+    S[..., 2] = onp.sign(onp.linalg.det(U) * onp.linalg.det(Vt))
+    R = U @ (S[..., :, None] * Vt)
+    trace = (D * S).sum(axis=-1)
+
+    if align == "sim3":
+        s = trace / onp.maximum(var_x, 1e-12)
+        mse = var_y - trace * s
+    else:
+        s = onp.ones(batch)
+        mse = var_y + var_x - 2 * trace
+    t = my - s[..., None] * onp.einsum("...ij,...j->...i", R, mx)
+    rmse = onp.where(finite, onp.sqrt(onp.maximum(mse, 0)), onp.nan)
+    return R, t, s, rmse
+
+
+def alignment(positions, gt, align="se3"):
+    """
+    (R, t, s) mapping estimated positions (..., T, 3) onto ground truth
+    positions (T, 3), see `_umeyama`.
+    """
+    R, t, s, _ = _umeyama(_sums(positions, gt), align)
+    return R, t, s
+
+
+def ate(positions, gt, align="se3"):
+    """
+    Absolute trajectory error (RMSE, m) of estimated positions (..., T, 3)
+    against ground truth positions (T, 3), after alignment (see `_umeyama`).
+    """
+    return _umeyama(_sums(positions, gt), align)[-1]
+
+
+def _distances(gt_positions):
+    # Distance traveled along the ground truth up to each frame
+    steps = onp.linalg.norm(onp.diff(gt_positions, axis=0), axis=-1)
+    return onp.concatenate(([0], onp.cumsum(steps)))
+
+
+def _segments(gt_positions, lengths=_lengths, step=10):
+    """
+    KITTI evaluation segments: first frames (K,), last frames (K,) and
+    length indices (K,) for every `step`-th first frame and every length that
+    the ground truth covers after it.
+    """
+    dist = _distances(gt_positions)
+    first = onp.arange(0, len(dist), step)
+    last = onp.searchsorted(dist, dist[first][:, None] + onp.asarray(lengths),
+                            side="right")
+    k, l = onp.nonzero(last < len(dist))
+    return first[k], last[k, l], l
+
+
+def _segment_errors(T_first, T_last, G_first, G_last, lengths):
+    """
+    Translation (m/m) and rotation (rad/m) errors of estimated transforms
+    (..., K, 4, 4) over segments with ground truth transforms (K, 4, 4) and
+    lengths (K,).
+    """
+    error = _inv(_inv(G_first) @ G_last) @ (_inv(T_first) @ T_last)
+    t_err = onp.linalg.norm(error[..., :3, 3], axis=-1)
+    cos = (onp.trace(error[..., :3, :3], axis1=-2, axis2=-1) - 1) / 2
+    r_err = onp.arccos(onp.clip(cos, -1, 1))
+    return t_err / lengths, r_err / lengths
+
+
+def _per_length(t_err, r_err, l, num_lengths):
+    # Sums and counts of segment errors (..., K) per length (..., L)
+    one_hot = l[:, None] == onp.arange(num_lengths)
+    return t_err @ one_hot, r_err @ one_hot, one_hot.sum(axis=0)
+
+
+def _report(t_sum, r_sum, counts, lengths):
+    # KITTI units: translation in %, rotation in deg/m
+    with onp.errstate(invalid="ignore", divide="ignore"):
+        return dict(
+            t_err=100 * t_sum.sum(axis=-1) / counts.sum(),
+            r_err=onp.degrees(r_sum.sum(axis=-1)) / counts.sum(),
+            t_err_per_length=100 * t_sum / counts,
+            r_err_per_length=onp.degrees(r_sum) / counts,
+            lengths=onp.asarray(lengths),
+            segments=counts)
+
+
+def rpe(poses, gt_poses, lengths=_lengths, step=10):
+    """
+    KITTI relative pose error of estimated poses (..., T, 7) or
+    (..., T, 3, 4) against ground truth poses (T, 3, 4).
+
+    Returns a dict with the mean translation (%) and rotation (deg/m) errors
+    over all segments (...,) and per length (..., L) (NaN for lengths no
+    segment covers), and the number of segments per length (L,).
+    """
+    T, G = _homogeneous(poses), _homogeneous(gt_poses)
+    first, last, l = _segments(G[:, :3, 3], lengths, step)
+    t_err, r_err = _segment_errors(T[..., first, :, :], T[..., last, :, :],
+                                   G[first], G[last],
+                                   onp.asarray(lengths, dtype=float)[l])
+    return _report(*_per_length(t_err, r_err, l, len(lengths)), lengths)
+
+
+def evaluate(poses, gt_poses, lengths=_lengths, step=10, align="se3"):
+    """
+    ATE (m) and RPE (see `rpe`) of estimated poses (..., T, 7) or
+    (..., T, 3, 4) against ground truth poses (T, 3, 4).
+    """
+    T = _homogeneous(poses)
+    G = _homogeneous(gt_poses)
+    return dict(ate=ate(T[..., :3, 3], G[:, :3, 3], align),
+                **rpe(T, G, lengths, step))
+
+
+class TrajectoryEvaluator:
+    """
+    ATE and RPE of a trajectory whose poses arrive one frame at a time, in
+    any order, against ground truth poses (N, 3, 4).
+
+    `append(i, pose)` adds frame i's pose ((7,) position + wxyz or (3, 4));
+    `summary()` gives the same numbers `evaluate` would for the frames so
+    far.
+    """
+
+    def __init__(self, gt_poses, lengths=_lengths, step=10, align="se3"):
+        self.gt = _homogeneous(gt_poses)
+        self.lengths = lengths
+        self.align = align
+        self.poses = onp.full((len(self.gt), 4, 4), onp.nan)
+        self.count = 0
+
+        # Running alignment sums (see `_sums`)
+        self._sums = [0, onp.zeros(3), onp.zeros(3), onp.zeros((3, 3)), 0.0,
+                      0.0]
+
+        # Segments are scored once both of their ends are in
+        first, last, l = _segments(self.gt[:, :3, 3], lengths, step)
+        self._segments = {}
+        for k in range(len(first)):
+            for end in (first[k], last[k]):
+                self._segments.setdefault(end, []).append(k)
+        self._first, self._last, self._l = first, last, l
+        self._t_sum = onp.zeros(len(lengths))
+        self._r_sum = onp.zeros(len(lengths))
+        self._counts = onp.zeros(len(lengths), dtype=int)
+
+    def append(self, i, pose):
+        T = _homogeneous(pose)
+        self.poses[i] = T
+        self.count += 1
+
+        x, y = T[:3, 3], self.gt[i, :3, 3]
+        for k, s in enumerate((1, x, y, onp.outer(y, x), x @ x, y @ y)):
+            self._sums[k] = self._sums[k] + s
+
+        for k in self._segments.pop(i, ()):
+            a, b = self._first[k], self._last[k]
+            if onp.isnan(self.poses[a, 0, 0]) or onp.isnan(self.poses[b, 0,
+                                                                       0]):
+                # The other end is still missing
+                continue
+            l = self._l[k]
+            t_err, r_err = _segment_errors(self.poses[a], self.poses[b],
+                                           self.gt[a], self.gt[b],
+                                           self.lengths[l])
+            self._t_sum[l] += t_err
+            self._r_sum[l] += r_err
+            self._counts[l] += 1
+
+    def ate(self):
+        if not self.count:
+            return onp.nan
+        return float(_umeyama(tuple(self._sums), self.align)[-1])
+
+    def summary(self):
+        """
+        ATE (m) and RPE (see `rpe`) of the frames so far.
+        """
+        return dict(ate=self.ate(),
+                    **_report(self._t_sum, self._r_sum, self._counts,
+                              self.lengths))
+
+
+if __name__ == "__main__":
+    import ekf
+    from dataset import KittiSequence
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trajectory",
+                        help="poses (T, 7) saved by `python -m vo run`")
+    parser.add_argument("--seq", default="00")
+    parser.add_argument("--root", default=ekf.dataset_root)
+    parser.add_argument("--lengths", nargs="+", type=float, default=_lengths)
+    parser.add_argument("--step", type=int, default=10)
+    parser.add_argument("--align", default="se3", choices=("se3", "sim3",
+                                                           "none"))
+    args = parser.parse_args()
+
+    poses = onp.load(args.trajectory)
+    gt_poses = KittiSequence(args.root, args.seq).poses[:len(poses)]
+    result = evaluate(poses, gt_poses, args.lengths, args.step,
+                      None if args.align == "none" else args.align)
+    print(f"ATE {result['ate']:.4f} m, RPE {result['t_err']:.4f} %, "
+          f"{result['r_err']:.6f} deg/m over {result['segments'].sum()} "
+          f"segments")
+    for length, t, r, n in zip(result["lengths"], result["t_err_per_length"],
+                               result["r_err_per_length"], result["segments"]):
+        print(f"  {length:6.0f} m: {t:8.4f} %, {r:.6f} deg/m ({n} segments)")
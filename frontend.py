@@ -0,0 +1,374 @@
+# Image front end
+# Loading, optical-flow tracking, corner detection and stereo triangulation.
+# None of it depends on the filter state, so the measurements can be produced
+# once and replayed into any number of EKF back ends (see sweep.py).
+
+from typing import NamedTuple
+
+import cv2
+import numpy as onp
+
+from disparity import DisparityCache, DisparityService
+from instrument import Profiler
+from loader import StereoPrefetcher, _imread
+from detector import GridDetector
+from mapping import _descriptors
+from stereo import _sparse_disparity
+from tracker import LKTracker
+
+# Stereo matching (disparity search range)
+window_size = 5
+min_disp = 0
+num_disp = 64
+sgbm_params = dict(minDisparity=min_disp,
+                   numDisparities=num_disp,
+                   blockSize=16,
+                   P1=8 * 3 * window_size**2,
+                   P2=8 * 3 * window_size**2,
+                   disp12MaxDiff=1,
+                   uniquenessRatio=10,
+                   speckleWindowSize=100,
+                   speckleRange=32)
+# Corners closer than this (smaller disparity, in pixels) are not triangulated
+min_disparity = 10
+# Corner detection (new corners also keep this far from existing tracks, in
+# pixels)
+quality_level = 0.1
+min_distance = 50
+
+lk_params = dict(
+    winSize=(15, 15),
+    maxLevel=2,
+    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03),
+)
+
+
+class Frame(NamedTuple):
+    """
+    Front-end output for one frame. Landmark quantities are per slot.
+    """
+    i: int
+    t: float
+    left: onp.ndarray
+    right: onp.ndarray
+    # Slot locations in the previous / this frame (S, 2), tracking status (S,)
+    # and forward-backward tracking error (S,) in pixels (inf when lost)
+    p0: onp.ndarray
+    p1: onp.ndarray
+    st: onp.ndarray
+    quality: onp.ndarray
+    # Set on discovery frames only: the new corners (M, 2), their disparities
+    # and the full disparity map (if one was computed). The new landmarks in
+    # view space (S, 3) with their covariance for unit pixel noise (S, 3, 3)
+    # are only valid in the `new` slots. `active` (S,) is the set of slots
+    # after the update, `retired` the tracks dropped from it
+    corners: onp.ndarray = None
+    disparity_corners: onp.ndarray = None
+    disparity: onp.ndarray = None
+    features: onp.ndarray = None
+    features_cov: onp.ndarray = None
+    new: onp.ndarray = None
+    active: onp.ndarray = None
+    retired: onp.ndarray = None
+    # With a landmark map, also on discovery frames: the slot descriptors
+    # before the update (S, P) (for the retired ones) and the `reactivated`
+    # slots (S,) with their world locations (S, 3) and covariances (S, 3, 3)
+    # from the map
+    descriptors: onp.ndarray = None
+    reactivated: onp.ndarray = None
+    landmarks: onp.ndarray = None
+    landmarks_cov: onp.ndarray = None
+    # Dropped by the real-time scheduler (nothing tracked, prediction only)
+    skipped: bool = False
+
+
+class FrontEnd:
+    """
+    Produces a `Frame` per stereo pair of `sequence`.
+
+    `first()` detects and triangulates the initial landmarks on frame 0, then
+    iterating yields the tracked measurements for frames 1, 2, ...
+
+    Every `discover_freq` frames, tracks that have been lost for `max_misses`
+    frames in a row are retired and new corners (away from the remaining
+    tracks) are triangulated into the free slots, up to `target_features`
+    landmarks. Tracks that are still good keep their slot.
+
+    With a `scheduler` (see scheduler.py), frames are paced by their
+    timestamps and, when behind, skipped, discoveries postponed and the number
+    of landmarks capped.
+
+    With a `disparity_cache` directory, full StereoSGBM maps (with
+    `keep_disparity` or without `sparse_stereo`) come from a disk cache of at
+    most `disparity_cache_bytes`, and the maps of upcoming discovery frames
+    are computed ahead on a background thread (see disparity.py).
+
+    With a `landmark_map` (see mapping.py), discovery first re-activates
+    mapped landmarks that are back in view, then triangulates new ones into
+    the slots that are still free. The map predicts the pose from the
+    filter's latest state, so the front end must then run in lockstep with
+    the filter (not on a BackgroundIterator).
+    """
+
+    def __init__(self,
+                 sequence,
+                 num_frames=None,
+                 max_features=10,
+                 target_features=None,
+                 max_misses=3,
+                 discover_freq=10,
+                 discover_features=True,
+                 sparse_stereo=True,
+                 prefetch_depth=4,
+                 keep_disparity=False,
+                 fb_threshold=1.0,
+                 grid=(4, 8),
+                 min_distance=min_distance,
+                 scheduler=None,
+                 disparity_cache=None,
+                 disparity_cache_bytes=2**30,
+                 landmark_map=None,
+                 prof=None):
+        self.sequence = sequence
+        self.num_frames = num_frames
+        self.max_features = max_features
+        self.target_features = target_features or max_features
+        assert self.target_features <= max_features
+        self.max_misses = max_misses
+        self.discover_freq = discover_freq
+        self.discover_features = discover_features
+        self.sparse_stereo = sparse_stereo
+        self.prefetch_depth = prefetch_depth
+        # Compute the full SGBM map even in sparse mode (for plots)
+        self.keep_disparity = keep_disparity
+        self.scheduler = scheduler
+        self.landmark_map = landmark_map
+        self.prof = prof or Profiler(enabled=False)
+
+        self.camera = sequence.camera
+
+        self.stereo = cv2.StereoSGBM_create(**sgbm_params)
+        self.disparities = None
+        if disparity_cache is not None and (keep_disparity or
+                                            not sparse_stereo):
+            self.disparities = DisparityService(
+                DisparityCache(disparity_cache, sgbm_params,
+                               disparity_cache_bytes), sgbm_params)
+
+        self.tracker = LKTracker(lk_params["winSize"],
+                                 lk_params["maxLevel"],
+                                 lk_params["criteria"],
+                                 fb_threshold=fb_threshold)
+        self.detector = GridDetector(*grid,
+                                     quality_level=quality_level,
+                                     min_distance=min_distance)
+        # Per slot: location in the last frame, whether it holds a landmark
+        # and for how many frames in a row it has not been tracked
+        self.p0 = onp.zeros((max_features, 2), dtype=onp.float32)
+        self.active = onp.zeros(max_features, dtype=bool)
+        self.misses = onp.zeros(max_features, dtype=int)
+        if landmark_map is not None:
+            # Patch descriptor of each slot's landmark, kept for the map
+            self.descriptors = onp.zeros(
+                (max_features, landmark_map.patch_size**2), onp.float32)
+        # A discovery is due but was skipped or postponed
+        self._discovery_due = False
+        self.frames = None
+
+    def _track_mask(self, shape):
+        # 0 around the landmarks we already track, None when there are none
+        if not self.active.any():
+            return None
+        mask = onp.full(shape, 255, dtype=onp.uint8)
+        for x, y in self.p0[self.active].astype(int):
+            cv2.circle(mask, (int(x), int(y)), self.detector.min_distance, 0,
+                       -1)
+        return mask
+
+    def _detect(self, left, max_corners):
+        # NOTE: number of features found may be <= max_corners, no guarantee
+        if max_corners == 0:
+            return onp.zeros((0, 2), dtype=int)
+
+        with self.prof.stage("detect"):
+            # Keep new corners away from the landmarks we already track
+            mask = self._track_mask(left.shape)
+            corners, _ = self.detector.detect(left, max_corners, mask)
+            return corners
+
+    def _reactivate(self, t, left, free):
+        """
+        Put mapped landmarks that are back in view into free slots.
+
+        Returns the slots' reactivated mask (S,), world locations (S, 3) and
+        covariances (S, 3, 3), and the slots that are still free.
+        """
+        S = self.max_features
+        reactivated = onp.zeros(S, dtype=bool)
+        landmarks = onp.zeros((S, 3))
+        landmarks_cov = onp.zeros((S, 3, 3))
+        if len(free):
+            with self.prof.stage("reactivate"):
+                _, corners, world, world_cov, descriptors = (
+                    self.landmark_map.reactivate(
+                        t, left, len(free), self._track_mask(left.shape)))
+            slots = free[:len(corners)]
+            reactivated[slots] = True
+            landmarks[slots] = world
+            landmarks_cov[slots] = world_cov
+            self.descriptors[slots] = descriptors
+
+            self.active |= reactivated
+            self.p0[slots] = corners
+            self.misses[slots] = 0
+            free = free[len(corners):]
+        return reactivated, landmarks, landmarks_cov, free
+
+    def _pair(self, i):
+        return (self.sequence.left_img_paths[i],
+                self.sequence.right_img_paths[i])
+
+    def _prefetch_disparities(self, i, stop):
+        # Queue the maps of the next few discovery frames from frame i on
+        if self.disparities is None or not self.discover_features:
+            return
+        f = self.discover_freq
+        start = -(-i // f) * f
+        stop = min(stop, start + self.prefetch_depth * f)
+        self.disparities.prefetch(self._pair(k) for k in range(start, stop, f))
+
+    def _disparity(self, i, left, right, corners):
+        with self.prof.stage("stereo"):
+            disparity = None
+            if self.disparities is not None:
+                disparity = self.disparities.get(*self._pair(i), left, right)
+            elif self.keep_disparity or not self.sparse_stereo:
+                # Convert to pixel-level disparity
+                disparity = self.stereo.compute(left, right) / 16.0
+            if not len(corners):
+                disparity_corners = onp.zeros(0)
+            elif self.sparse_stereo:
+                disparity_corners = _sparse_disparity(left, right, corners,
+                                                      min_disp, num_disp)
+            else:
+                disparity_corners = disparity[corners[:, 1],
+                                              corners[:, 0]].astype(float)
+            return disparity, disparity_corners
+
+    def _discover(self, i, t, left, right, p0, p1, st, quality):
+        """
+        Retire lost tracks and triangulate new landmarks into free slots.
+        """
+        S = self.max_features
+        retired = self.active & (self.misses >= self.max_misses)
+        self.active &= ~retired
+
+        target = self.target_features
+        cap = self.scheduler and self.scheduler.feature_cap()
+        if cap is not None:
+            # Behind schedule: also retire the worst tracks over the cap
+            target = min(target, cap)
+            worst = onp.argsort(-quality, kind="stable")
+            worst = worst[self.active[worst]][:max(0, self.active.sum() - cap)]
+            retired[worst] = True
+            self.active[worst] = False
+
+        # Refill up to the target count
+        free = onp.flatnonzero(~self.active)
+        free = free[:max(0, target - self.active.sum())]
+        mapped = {}
+        if self.landmark_map is not None:
+            mapped["descriptors"] = self.descriptors.copy()
+            (mapped["reactivated"], mapped["landmarks"],
+             mapped["landmarks_cov"], free) = self._reactivate(t, left, free)
+        corners = self._detect(left, len(free))
+        disparity, disparity_corners = self._disparity(i, left, right,
+                                                       corners)
+
+        # Filter out certain points
+        valid = disparity_corners > min_disparity
+        disparity_corners = disparity_corners[valid]
+        corners = corners[valid]
+
+        slots = free[:len(corners)]
+        new = onp.zeros(S, dtype=bool)
+        new[slots] = True
+        features = onp.zeros((S, 3))
+        features_cov = onp.zeros((S, 3, 3))
+        features[slots] = self.camera.backproject_disparity(
+            corners, disparity_corners)
+        features_cov[slots] = self.camera.backproject_cov(features[slots])
+
+        # Start tracking the new corners
+        self.active |= new
+        self.p0[slots] = corners
+        self.misses[slots] = 0
+        if self.landmark_map is not None:
+            self.descriptors[slots] = _descriptors(
+                left, corners, self.landmark_map.patch_size)
+
+        return Frame(i, t, left, right, p0, p1, st, quality, corners,
+                     disparity_corners, disparity, features, features_cov, new,
+                     self.active.copy(), retired, **mapped)
+
+    def first(self):
+        left = _imread(self.sequence.left_img_paths[0])
+        right = _imread(self.sequence.right_img_paths[0])
+        self.tracker.reset(left)
+        S = self.max_features
+        return self._discover(0, self.sequence.times[0], left, right,
+                              self.p0.copy(), self.p0.copy(),
+                              onp.zeros(S, onp.uint8), onp.full(S, onp.inf))
+
+    def __iter__(self):
+        if self.tracker._prev is None:
+            raise RuntimeError("call first() before iterating")
+
+        self.frames = StereoPrefetcher(self.sequence.left_img_paths,
+                                       self.sequence.right_img_paths,
+                                       self.sequence.times,
+                                       start=1,
+                                       stop=self.num_frames,
+                                       depth=self.prefetch_depth)
+        try:
+            for i, t, left, right in self.prof.iterate("load", self.frames):
+                self._prefetch_disparities(i, self.frames.stop)
+                due = (self._discovery_due or i % self.discover_freq == 0
+                       ) and self.discover_features
+                if self.scheduler is not None:
+                    self.scheduler.wait(i)
+                    if self.scheduler.skip(i):
+                        # Tracking resumes from the last tracked frame
+                        self._discovery_due = due
+                        S = self.max_features
+                        yield Frame(i, t, left, right, self.p0.copy(),
+                                    self.p0.copy(), onp.zeros(S, onp.uint8),
+                                    onp.full(S, onp.inf), skipped=True)
+                        continue
+                    due = due and self.scheduler.discover(i)
+
+                # Track features
+                with self.prof.stage("track"):
+                    p0 = self.p0.copy()
+                    p1, st, quality = self.tracker.track(left, p0, self.active)
+
+                # Update feature tracking. Lost tracks are searched for again
+                # from their last known location until they are retired
+                tracked = st == 1
+                self.p0 = onp.where(tracked[:, None], p1, p0)
+                self.misses = onp.where(tracked, 0, self.misses + self.active)
+
+                if due:
+                    self._discovery_due = False
+                    yield self._discover(i, t, left, right, p0, p1, st,
+                                         quality)
+                else:
+                    # Postponed discoveries stay due
+                    self._discovery_due |= (i % self.discover_freq == 0 and
+                                            self.discover_features)
+                    yield Frame(i, t, left, right, p0, p1, st, quality)
+        finally:
+            self.frames.close()
+            self.detector.close()
+            if self.disparities is not None:
+                self.disparities.close()
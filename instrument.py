@@ -0,0 +1,204 @@
+# Instrumentation for the VO pipeline
+# Per-stage wall-clock timers (synchronized with JAX's async dispatch), JIT
+# trace/compile counters and per-frame memory, exportable as CSV or as a Chrome
+# trace (chrome://tracing, https://ui.perfetto.dev).
+
+import csv
+import functools
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import jax
+from jax import monitoring
+
+# Number of times each wrapped function has been traced (see `_counted`)
+traces = Counter()
+# Number of backend compilations (and seconds spent) per jitted function name
+compiles = Counter()
+compile_time = defaultdict(float)
+_compile_log = []
+
+
+def _counted(name):
+    """
+    Count traces of a function that is about to be jitted.
+
+    The wrapper body only runs while JAX traces the function, so the counter
+    goes up once per compile/retrace (new shapes, dtypes or static args) and
+    not on cache hits.
+    """
+
+    def wrap(fn):
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            traces[name] += 1
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return wrap
+
+
+def _on_event(event, duration, **kwargs):
+    if event.endswith("backend_compile_duration"):
+        name = kwargs.get("fun_name", "?")
+        compiles[name] += 1
+        compile_time[name] += duration
+        _compile_log.append((name, time.perf_counter() - duration, duration))
+
+
+monitoring.register_event_duration_secs_listener(_on_event)
+
+
+def _sync(outputs):
+    jax.block_until_ready([x for x in outputs if isinstance(x, jax.Array)])
+
+
+class Profiler:
+    """
+    Collects per-frame stage timings and memory.
+
+    Wrap each stage in `with prof.stage(name) as sync:` and pass the stage's
+    JAX outputs to `sync(...)`; they are waited on before the stage is timed,
+    so asynchronously dispatched work is charged to the stage that launched
+    it. When disabled, stages are free and nothing is synchronized.
+
+    The current frame is tracked per thread, so pipeline stages running on
+    different threads (see loader.BackgroundIterator) each charge their own
+    frame.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._local = threading.local()
+        self.events = []  # (frame, stage, start, duration, thread)
+        self.memory = []  # (frame, time, {name: bytes})
+        self._bytes = Counter()
+        self._t0 = time.perf_counter()
+
+    @property
+    def frame(self):
+        return getattr(self._local, "frame", None)
+
+    @frame.setter
+    def frame(self, frame):
+        self._local.frame = frame
+
+    def _record(self, name, t0):
+        self.events.append((self.frame, name, t0, time.perf_counter() - t0,
+                            threading.current_thread().name))
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield lambda *outputs: None
+            return
+
+        outputs = []
+        t0 = time.perf_counter()
+        yield lambda *x: outputs.extend(x)
+        _sync(outputs)
+        self._record(name, t0)
+
+    def iterate(self, name, frames):
+        """
+        Iterate over `frames` (tuples starting with the frame index), timing
+        each `next()` as stage `name` of the frame it returns.
+        """
+        frames = iter(frames)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                frame = next(frames)
+            except StopIteration:
+                return
+            self.frame = frame[0]
+            if self.enabled:
+                self._record(name, t0)
+            yield frame
+
+    def track_memory(self, **nbytes):
+        """
+        Record bytes added to each named buffer this frame
+        (e.g. mus=mu.nbytes).
+        """
+        if not self.enabled:
+            return
+        self._bytes.update(nbytes)
+        self.memory.append(
+            (self.frame, time.perf_counter(), dict(self._bytes)))
+
+    def totals(self):
+        totals = defaultdict(float)
+        for _, name, _, duration, _ in self.events:
+            totals[name] += duration
+        return dict(totals)
+
+    def summary(self):
+        lines = []
+        frames = len({e[0] for e in self.events if e[0] is not None}) or 1
+        for name, total in sorted(self.totals().items(), key=lambda x: -x[1]):
+            lines.append(f"{name:>12}: {total:8.3f} s "
+                         f"({1e3 * total / frames:7.2f} ms/frame)")
+        lines.append(f"traces: {dict(traces)}")
+        lines.append(f"compiles: {sum(compiles.values())} "
+                     f"({sum(compile_time.values()):.2f} s)")
+        if self.memory:
+            lines.append(f"memory: {self.memory[-1][2]}")
+        return "\n".join(lines)
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["frame", "stage", "start_s", "duration_s", "thread"])
+            for frame, name, start, duration, thread in self.events:
+                w.writerow([frame, name, start - self._t0, duration, thread])
+
+    def memory_to_csv(self, path):
+        names = sorted({k for _, _, m in self.memory for k in m})
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["frame", *[f"{k}_bytes" for k in names]])
+            for frame, _, m in self.memory:
+                w.writerow([frame, *[m.get(k, 0) for k in names]])
+
+    def to_chrome_trace(self, path):
+        us = lambda t: 1e6 * (t - self._t0)
+        # One row per thread, compiles on a row of their own
+        threads = list(dict.fromkeys(e[4] for e in self.events))
+        events = [
+            dict(name=name,
+                 ph="X",
+                 ts=us(start),
+                 dur=1e6 * duration,
+                 pid=0,
+                 tid=threads.index(thread),
+                 args=dict(frame=frame))
+            for frame, name, start, duration, thread in self.events
+        ]
+        events += [
+            dict(name="thread_name",
+                 ph="M",
+                 pid=0,
+                 tid=tid,
+                 args=dict(name=thread)) for tid, thread in enumerate(threads)
+        ]
+        events += [
+            dict(name=f"compile {name}",
+                 ph="X",
+                 ts=us(start),
+                 dur=1e6 * duration,
+                 pid=0,
+                 tid=len(threads)) for name, start, duration in _compile_log
+            if start >= self._t0
+        ]
+        events += [
+            dict(name="memory", ph="C", ts=us(t), pid=0, args=m)
+            for _, t, m in self.memory
+        ]
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=events), f)
@@ -0,0 +1,208 @@
+# Prefetching stereo image loader
+# PNG decodes (cv2.imread) release the GIL, so a small thread pool can read the
+# next few stereo pairs while the filter is busy with the current one.
+# `BackgroundIterator` does the same for a whole pipeline stage (e.g. the
+# OpenCV front end) on its own thread.
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+
+def _imread(p):
+    return cv2.imread(str(p), cv2.IMREAD_GRAYSCALE)
+
+
+class StereoPrefetcher:
+    """
+    Iterate over stereo pairs, yielding (i, t, left, right).
+
+    Up to `depth` pairs ahead of the consumer are decoded on a bounded thread
+    pool. `hits` counts frames that were already decoded when requested,
+    `stalls` counts frames the consumer had to wait for (`stall_time` seconds
+    in total).
+    """
+
+    def __init__(self,
+                 left_paths,
+                 right_paths,
+                 times,
+                 start=0,
+                 stop=None,
+                 depth=4,
+                 workers=2,
+                 load=_imread):
+        assert len(left_paths) == len(right_paths) == len(times)
+        assert depth >= 1
+        self.left_paths = left_paths
+        self.right_paths = right_paths
+        self.times = times
+        self.start = start
+        self.stop = len(times) if stop is None else min(stop, len(times))
+        self.depth = depth
+        self.load = load
+
+        self.hits = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="prefetch")
+        self._pending = deque()
+        self._next = start
+
+    def _submit(self):
+        i = self._next
+        self._pending.append((
+            i,
+            self._pool.submit(self.load, self.left_paths[i]),
+            self._pool.submit(self.load, self.right_paths[i]),
+        ))
+        self._next += 1
+
+    def _fill(self):
+        while len(self._pending) < self.depth and self._next < self.stop:
+            self._submit()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._fill()
+        if not self._pending:
+            self.close()
+            raise StopIteration
+
+        i, left, right = self._pending.popleft()
+        if left.done() and right.done():
+            self.hits += 1
+        else:
+            self.stalls += 1
+            t0 = time.perf_counter()
+            left.result(), right.result()
+            self.stall_time += time.perf_counter() - t0
+
+        # Keep the pool busy while the caller works on this frame
+        self._fill()
+        return i, self.times[i], left.result(), right.result()
+
+    def close(self):
+        for _, left, right in self._pending:
+            left.cancel()
+            right.cancel()
+        self._pending.clear()
+        self._pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Queue message kinds
+_item, _done, _error = range(3)
+
+
+class BackgroundIterator:
+    """
+    Run `iterable` on a worker thread, at most `depth` items ahead of the
+    consumer.
+
+    The bounded queue gives backpressure: the producer blocks (`blocked_time`
+    seconds in total) once it is `depth` items ahead. Items come out in order
+    and exceptions raised by the producer are re-raised by `next()`. Counters
+    as for `StereoPrefetcher` (`hits`, `stalls`, `stall_time`) measure how
+    often the consumer had to wait.
+    """
+
+    def __init__(self, iterable, depth=2, name="pipeline"):
+        assert depth >= 1
+        self.depth = depth
+
+        self.hits = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.blocked_time = 0.0
+
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(iterable, ),
+                                        name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, message):
+        t0 = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                # Time out now and then to notice close()
+                self._queue.put(message, timeout=0.1)
+                self.blocked_time += time.perf_counter() - t0
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterable):
+        it = iter(iterable)
+        try:
+            for x in it:
+                if not self._put((_item, x)):
+                    break
+            else:
+                self._put((_done, None))
+        except BaseException as e:
+            self._put((_error, e))
+        finally:
+            # Generators clean up (e.g. close their loaders) on this thread
+            close = getattr(it, "close", None)
+            if close is not None:
+                close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+
+        try:
+            kind, x = self._queue.get_nowait()
+            self.hits += 1
+        except queue.Empty:
+            self.stalls += 1
+            t0 = time.perf_counter()
+            kind, x = self._queue.get()
+            self.stall_time += time.perf_counter() - t0
+
+        if kind == _item:
+            return x
+        self._finished = True
+        self._thread.join()
+        if kind == _error:
+            raise x
+        raise StopIteration
+
+    def close(self):
+        self._finished = True
+        self._stop.set()
+        # Unblock a producer waiting on a full queue
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
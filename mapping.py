@@ -0,0 +1,255 @@
+# Persistent landmark map
+# Landmarks dropped from the filter state (retired tracks) are kept with their
+# world position, covariance and an image patch descriptor in a voxel hash, so
+# that when they come back into view at a discovery frame they can be matched
+# and put back into the state instead of triangulating new points.
+#
+# The index is a sorted array of voxel keys (one per landmark) searched with
+# `searchsorted` for the voxels around the view frustum, plus a small buffer of
+# recent insertions that is scanned linearly and merged into the sorted array
+# once it holds `buffer_size` landmarks. Queries only touch the landmarks
+# near the camera, so they stay well under a millisecond for maps of hundreds
+# of thousands of points.
+
+import cv2
+import numpy as onp
+from numpy.lib.stride_tricks import sliding_window_view
+
+from model import _f
+from q import _as_matrix_host
+
+# Voxel coordinates are packed into one int64 key, 21 bits per axis
+_bits = 21
+_offset = 2**(_bits - 1)
+
+
+def _keys(voxels):
+    v = (voxels + _offset).astype(onp.int64)
+    return (v[..., 0] << (2 * _bits)) | (v[..., 1] << _bits) | v[..., 2]
+
+
+def _normalize_patches(patches):
+    # Zero mean, unit norm (so that a dot product is the ZNCC)
+    h, w = patches.shape[-2:]
+    patches = patches.reshape((*patches.shape[:-2], h * w)).astype(onp.float32)
+    patches = patches - patches.mean(axis=-1, keepdims=True)
+    norm = onp.linalg.norm(patches, axis=-1, keepdims=True)
+    return patches / onp.maximum(norm, 1e-6)
+
+
+def _descriptors(img, corners, size=11):
+    """
+    Normalized size x size patches (M, size^2) around integer pixel corners
+    (M, 2).
+    """
+    r = size // 2
+    padded = onp.pad(img, r, mode="edge")
+    x, y = onp.reshape(corners, (-1, 2)).astype(int).T
+    offsets = onp.arange(size)
+    patches = padded[(y[:, None] + offsets)[:, :, None],
+                     (x[:, None] + offsets)[:, None, :]]
+    return _normalize_patches(patches)
+
+
+class LandmarkMap:
+    """
+    Retired landmarks of a sequence seen through `camera` (calib.StereoCamera).
+
+    The filter calls `set_state(t, mu)` with every posterior and `insert`s
+    retired landmarks; at discovery frames the front end calls `reactivate`,
+    which predicts the pose at the frame time with the motion model, finds the
+    landmarks in view (up to `max_depth` m) and matches their descriptors
+    within `search_radius` pixels of where they should project. Matched
+    landmarks leave the map (they are back in the filter state).
+    """
+
+    def __init__(self,
+                 camera,
+                 voxel_size=5.0,
+                 max_depth=50.0,
+                 patch_size=11,
+                 search_radius=8,
+                 min_ncc=0.8,
+                 min_distance=50,
+                 buffer_size=1024,
+                 capacity=1024):
+        self.camera = camera
+        self.voxel_size = voxel_size
+        self.max_depth = max_depth
+        self.patch_size = patch_size
+        self.search_radius = search_radius
+        self.min_ncc = min_ncc
+        self.min_distance = min_distance
+        self.buffer_size = buffer_size
+
+        self.size = 0
+        self.positions = onp.zeros((capacity, 3))
+        self.covs = onp.zeros((capacity, 3, 3))
+        self.descriptors = onp.zeros((capacity, patch_size**2), onp.float32)
+        self.alive = onp.zeros(capacity, dtype=bool)
+
+        # Sorted voxel keys of landmarks [0, _indexed) and the landmark ids in
+        # that order; landmarks [_indexed, size) are in the insertion buffer
+        self._keys = onp.zeros(0, dtype=onp.int64)
+        self._order = onp.zeros(0, dtype=int)
+        self._indexed = 0
+
+        self._t = None
+        self._pose = None
+
+        self.inserted = 0
+        self.reactivated = 0
+
+    def __len__(self):
+        return int(self.alive[:self.size].sum())
+
+    def _grow(self, n):
+        capacity = len(self.positions)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity)
+        for name in ("positions", "covs", "descriptors", "alive"):
+            old = getattr(self, name)
+            new = onp.zeros((capacity, *old.shape[1:]), dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _voxels(self, xyz):
+        return onp.floor(xyz / self.voxel_size).astype(onp.int64)
+
+    def _rebuild(self):
+        # Merge the insertion buffer into the sorted index
+        keys = _keys(self._voxels(self.positions[:self.size]))
+        self._order = onp.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+        self._indexed = self.size
+
+    def insert(self, positions, covs, descriptors):
+        """
+        Add landmarks with world positions (M, 3), covariances (M, 3, 3) and
+        descriptors (M, patch_size^2). Returns their ids.
+        """
+        M = len(positions)
+        ids = onp.arange(self.size, self.size + M)
+        self._grow(self.size + M)
+        self.positions[ids] = positions
+        self.covs[ids] = covs
+        self.descriptors[ids] = descriptors
+        self.alive[ids] = True
+        self.size += M
+        self.inserted += M
+        if self.size - self._indexed >= self.buffer_size:
+            self._rebuild()
+        return ids
+
+    def remove(self, ids):
+        self.alive[ids] = False
+
+    def _frustum_voxels(self, R, p):
+        # Keys of the voxels in the bounding box of the view frustum
+        c = self.camera
+        d = self.max_depth
+        corners = onp.array([[0, 0], [c.width, 0], [0, c.height],
+                             [c.width, c.height]])
+        far = onp.column_stack(((corners[:, 0] - c.cx) * d / c.fx,
+                                (corners[:, 1] - c.cy) * d / c.fy,
+                                onp.full(4, d)))
+        points = onp.vstack((far @ R.T + p, p))
+        lo, hi = self._voxels(points.min(axis=0)), self._voxels(
+            points.max(axis=0))
+        axes = [onp.arange(a, b + 1) for a, b in zip(lo, hi)]
+        grid = onp.stack(onp.meshgrid(*axes, indexing="ij"), axis=-1)
+        return _keys(grid.reshape((-1, 3)))
+
+    def query(self, wxyz, p):
+        """
+        Ids (K,) of the landmarks in view of a camera at position p with
+        orientation wxyz, and their pixel locations (K, 2) and depths (K,).
+        """
+        R = _as_matrix_host(wxyz)
+        p = onp.asarray(p, dtype=float)
+
+        # Sorted index: every landmark in a candidate voxel
+        candidates = self._frustum_voxels(R, p)
+        lo = onp.searchsorted(self._keys, candidates, side="left")
+        hi = onp.searchsorted(self._keys, candidates, side="right")
+        counts = hi - lo
+        starts = onp.repeat(lo - onp.cumsum(counts) + counts, counts)
+        ids = self._order[starts + onp.arange(counts.sum())]
+        # Insertion buffer
+        ids = onp.concatenate((ids, onp.arange(self._indexed, self.size)))
+        ids = ids[self.alive[ids]]
+
+        view = (self.positions[ids] - p) @ R
+        visible = self.camera.in_frame(view) & (view[:, 2] < self.max_depth)
+        ids, view = ids[visible], view[visible]
+        return ids, self.camera.project(view), view[:, 2]
+
+    def set_state(self, t, mu):
+        """
+        Latest filter posterior mu at time t (only the pose and velocities
+        are used).
+        """
+        self._t = t
+        self._pose = onp.asarray(mu[:13])
+
+    def predicted_pose(self, t):
+        """
+        (wxyz, p) at time t, predicted with the motion model from the latest
+        posterior.
+        """
+        x = onp.asarray(_f(self._pose, t - self._t))
+        return x[3:7], x[:3]
+
+    def _match(self, img, descriptor, guess):
+        # Best ZNCC of the descriptor within search_radius of the guess
+        r, s = self.search_radius, self.patch_size
+        h, w = img.shape
+        x0, y0 = int(round(guess[0])) - r - s // 2, int(round(
+            guess[1])) - r - s // 2
+        if x0 < 0 or y0 < 0 or x0 + 2 * r + s > w or y0 + 2 * r + s > h:
+            return None, -1.0
+        region = img[y0:y0 + 2 * r + s, x0:x0 + 2 * r + s]
+        patches = _normalize_patches(sliding_window_view(region, (s, s)))
+        ncc = patches @ descriptor  # (2r + 1) x (2r + 1)
+        dy, dx = onp.unravel_index(onp.argmax(ncc), ncc.shape)
+        return (x0 + dx + s // 2, y0 + dy + s // 2), float(ncc[dy, dx])
+
+    def reactivate(self, t, img, max_landmarks, mask=None):
+        """
+        Match up to max_landmarks landmarks in view at time t in the left
+        image, away from pixels where `mask` is 0 (existing tracks) and from
+        each other. Matched landmarks are removed from the map.
+
+        Returns their ids (K,), pixel corners (K, 2), world positions (K, 3),
+        covariances (K, 3, 3) and descriptors (K, patch_size^2).
+        """
+        found = [], []
+        if self._pose is not None and max_landmarks > 0 and self.size:
+            ids, uv, _ = self.query(*self.predicted_pose(t))
+            # Best localized first
+            order = onp.argsort(onp.trace(self.covs[ids], axis1=1, axis2=2))
+            ids, uv = ids[order], uv[order]
+            mask = (onp.full(img.shape, 255, onp.uint8)
+                    if mask is None else mask.copy())
+            for k, guess in zip(ids, uv):
+                u, v = guess.astype(int)
+                if not mask[v, u]:
+                    continue
+                corner, ncc = self._match(img, self.descriptors[k], guess)
+                if corner is None or ncc < self.min_ncc or not mask[
+                        corner[1], corner[0]]:
+                    continue
+                found[0].append(k)
+                found[1].append(corner)
+                cv2.circle(mask, (int(corner[0]), int(corner[1])),
+                           self.min_distance, 0, -1)
+                if len(found[0]) == max_landmarks:
+                    break
+
+        ids = onp.array(found[0], dtype=int)
+        corners = onp.array(found[1], dtype=int).reshape((-1, 2))
+        self.remove(ids)
+        self.reactivated += len(ids)
+        return (ids, corners, self.positions[ids], self.covs[ids],
+                self.descriptors[ids])
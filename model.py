@@ -0,0 +1,296 @@
+# Motion and observation models for the EKF
+# State: [p (3), q (wxyz, 4), v (3), w (3), features (3N)]
+
+import jax
+import jax.numpy as jnp
+import numpy as onp
+from jaxlie import SO3
+
+from instrument import _counted
+from q import _as_matrix, _from_axis_angle, _from_wxyz, _to_world
+
+
+# Manage the state (only robot pose at the start)
+def _split(x):
+    # First 13 elements are the robot pose
+    p = x[:3]
+    q = _from_wxyz(x[3:7])
+    v = x[7:10]
+    w = x[10:13]
+
+    # Rest of elements are the 3D feature locations
+    features = x[13:]
+    features = jnp.reshape(features, (-1, 3))
+    return p, q, v, w, features
+
+
+def _join(p, q, v, w, features):
+    # features.shape = (N, 3)
+    # q: jaxlie.SO3
+
+    return jnp.array([
+        *p,  #
+        *q.wxyz,
+        *v,
+        *w,
+        *features.flatten()
+    ])
+
+
+# State transition
+@jax.jit
+@_counted("_f")
+def _f(x, dt):
+    """
+    Constant velocity motion model. 
+    """
+    p, q, v, w, features = _split(x)
+    _p = p + v * dt
+
+    # Calculate axis-angle representation
+    w_norm = jnp.linalg.norm(w)
+    theta = dt * w_norm
+    _w = jnp.where(w_norm > 1e-8, w / w_norm, w)
+    r = _from_axis_angle(_w, theta)
+
+    # Ensure rotation
+    r = r.normalize()
+
+    # NOTE: the new instataneous rotation comes at the end, not before.
+    _q = q @ r
+    return _join(_p, _q, v, w, features)
+
+
+def _normalize(wxyz):
+    return SO3(wxyz).normalize().wxyz
+
+
+_j_normalize = jax.jit(jax.jacfwd(_normalize))
+
+
+def _normalize_q(x):
+    p, q, v, w, features = _split(x)
+    # Compute normalized quaternion
+    wxyz = q.wxyz
+    _q = _normalize(wxyz)
+    # Compute Jacobian
+    jq = _j_normalize(wxyz)
+    return _join(p, SO3(_q), v, w, features), jq
+
+
+# Observe
+def _g(x, camera):
+    """
+    Observation model.
+
+    Project each 3D feature to 2D plane based on estimated pose, using the
+    stereo camera's left (reference) camera (see calib.StereoCamera).
+    """
+    p, q, v, w, features = _split(x)
+
+    # Transform from world to view/camera space
+    features = camera.to_camera(q.wxyz, p, features)
+    projected_features = camera.project(features)
+    # Clip features to correct range
+    final = jnp.array([
+        jnp.clip(projected_features[:, 0], 0, camera.width),
+        jnp.clip(projected_features[:, 1], 0, camera.height)
+    ]).T
+    return final.flatten()
+
+
+_A = jax.jit(_counted("_A")(jax.jacfwd(_f)))
+_C = jax.jit(_counted("_C")(jax.jacfwd(_g)))
+
+# Closed-form Jacobians
+# _A and _C above differentiate over the whole state; they are kept as the
+# reference that the structured versions below are checked against.
+
+
+def _left(q):
+    # q @ r == _left(q) @ r.wxyz (Hamilton product)
+    w, x, y, z = q
+    return jnp.array([
+        [w, -x, -y, -z],  #
+        [x, w, -z, y],
+        [y, z, w, -x],
+        [z, -y, x, w],
+    ])
+
+
+def _right(r):
+    # q @ r == _right(r) @ q.wxyz
+    w, x, y, z = r
+    return jnp.array([
+        [w, -x, -y, -z],  #
+        [x, w, z, -y],
+        [y, -z, w, x],
+        [z, y, -x, w],
+    ])
+
+
+def _d_normalize(wxyz):
+    # Jacobian of wxyz / |wxyz|
+    norm = jnp.linalg.norm(wxyz)
+    u = wxyz / norm
+    return (jnp.identity(4, dtype=u.dtype) - jnp.outer(u, u)) / norm
+
+
+@jax.jit
+@_counted("_A_pose")
+def _A_pose(x, dt):
+    """
+    13 x 13 pose block of _A. _f leaves the landmarks untouched, so the rest of
+    _A is the identity and never needs to be formed.
+    """
+    p, q, v, w, _ = _split(x[:13])
+
+    # Same axis-angle construction as _f
+    w_norm = jnp.linalg.norm(w)
+    theta = dt * w_norm
+    big = w_norm > 1e-8
+    _w = jnp.where(big, w / w_norm, w)
+    r = _from_axis_angle(_w, theta).wxyz
+
+    # d(axis-angle quaternion) / dw, followed by its normalization
+    # (0 below the threshold, where the rotation is the identity's limit)
+    u = jnp.where(big, w / jnp.where(big, w_norm, 1), 0)
+    I3 = jnp.identity(3, dtype=x.dtype)
+    d_w = jnp.where(big, (I3 - jnp.outer(u, u)) / w_norm, I3)
+    s, c = jnp.sin(theta / 2), jnp.cos(theta / 2)
+    d_r = jnp.vstack((
+        -s / 2 * dt * u[None],  #
+        s * d_w + c / 2 * dt * jnp.outer(_w, u),
+    ))
+    d_r = _d_normalize(r) @ d_r
+    r = r / jnp.linalg.norm(r)
+
+    A = jnp.identity(13, dtype=x.dtype)
+    A = A.at[0:3, 7:10].set(dt * I3)
+    A = A.at[3:7, 3:7].set(_right(r))
+    A = A.at[3:7, 10:13].set(_left(q.wxyz) @ d_r)
+    return A
+
+
+def _d_rotate_inv(wxyz, d):
+    """
+    Jacobian of R(wxyz).T @ d with respect to a unit quaternion wxyz.
+
+    wxyz.shape = (4,), d.shape = (N, 3). Returns (N, 3, 4).
+    """
+    w, x, y, z = wxyz
+    d0, d1, d2 = d[:, 0], d[:, 1], d[:, 2]
+    rows = [
+        [
+            2 * z * d1 - 2 * y * d2,  #
+            2 * y * d1 + 2 * z * d2,
+            -4 * y * d0 + 2 * x * d1 - 2 * w * d2,
+            -4 * z * d0 + 2 * w * d1 + 2 * x * d2,
+        ],
+        [
+            -2 * z * d0 + 2 * x * d2,  #
+            2 * y * d0 - 4 * x * d1 + 2 * w * d2,
+            2 * x * d0 + 2 * z * d2,
+            -2 * w * d0 - 4 * z * d1 + 2 * y * d2,
+        ],
+        [
+            2 * y * d0 - 2 * x * d1,  #
+            2 * z * d0 - 2 * w * d1 - 4 * x * d2,
+            2 * w * d0 + 2 * z * d1 - 4 * y * d2,
+            2 * x * d0 + 2 * y * d1,
+        ],
+    ]
+    return jnp.stack([jnp.stack(r, axis=-1) for r in rows], axis=1)
+
+
+@jax.jit
+def _C_blocks(x, camera):
+    """
+    Structured Jacobian of _g.
+
+    Each feature's projection only depends on the pose and its own 3D location,
+    so instead of the dense (2N, 13 + 3N) matrix this returns a 2 x 13 pose
+    block (N, 2, 13) and a 2 x 3 landmark block (N, 2, 3) per feature.
+    """
+    p, q, v, w, features = _split(x)
+    wxyz = q.wxyz
+    R_ = _as_matrix(wxyz).T
+
+    d = features - p
+    c = d @ R_.T  # N x 3, camera space
+
+    # d(u, v) / dc, zeroed where the projection is clipped
+    inside = camera.inside(camera.project(c))
+    d_c = jnp.where(inside[..., None], camera.project_jacobian(c), 0)
+
+    # Chain through the camera transform c = R_ @ (xyz - p)
+    C_feat = d_c @ R_
+    d_q = _d_rotate_inv(wxyz / jnp.linalg.norm(wxyz), d) @ _d_normalize(wxyz)
+    C_pose = jnp.concatenate((
+        -C_feat,  #
+        d_c @ d_q,
+        jnp.zeros((len(c), 2, 6), dtype=C_feat.dtype),
+    ),
+                             axis=-1)
+    return C_pose, C_feat
+
+
+def _assemble_C(C_pose, C_feat):
+    # Scatter the per-feature blocks into the dense (2N, 13 + 3N) Jacobian
+    N = len(C_feat)
+    C_l = jnp.einsum("kij,kl->kilj", C_feat,
+                     jnp.identity(N, dtype=C_feat.dtype))
+    return jnp.hstack((C_pose.reshape((2 * N, 13)), C_l.reshape(
+        (2 * N, 3 * N))))
+
+
+@jax.jit
+@_counted("_C_structured")
+def _C_structured(x, camera):
+    return _assemble_C(*_C_blocks(x, camera))
+
+
+def _check_jacobians(x, dt, camera, rtol=1e-5, atol=1e-6):
+    """
+    Check the closed-form Jacobians against the autodiff reference.
+    """
+    A = _A(x, dt)
+    onp.testing.assert_allclose(_A_pose(x, dt),
+                                A[:13, :13],
+                                rtol=rtol,
+                                atol=atol)
+    onp.testing.assert_allclose(A[:13, 13:], 0, atol=atol)
+    onp.testing.assert_allclose(A[13:, 13:],
+                                jnp.identity(len(x) - 13),
+                                atol=atol)
+    onp.testing.assert_allclose(_C_structured(x, camera),
+                                _C(x, camera),
+                                rtol=rtol,
+                                atol=atol)
+
+
+def _update_mu(_mu, K, inno):
+    add_term = K @ inno
+    return _mu + add_term
+
+    # Modified quaternion update
+    mu = _mu + add_term
+
+    # Don't add quaternions, rotate existing orientation by new quaternion
+    q = SO3(_mu[3:7])
+    new_q = q @ SO3.exp(add_term[3:6]).normalize()
+    # embed()
+    mu = mu.at[3:7].set(new_q.wxyz)
+    return mu
+
+
+def _landmark_init(x, features):
+    """
+    World locations (N, 3) of landmarks seen at `features` (N, 3) in the
+    current view, with their Jacobians with respect to the pose part of the
+    state (N, 3, 13) and to the view-space location (the rotation, 3 x 3).
+    """
+
+    l = lambda pose: _to_world(pose[3:7], pose[:3], features)
+    J_pose = jax.jacfwd(l)(x[:13])  # (N, 3, 13)
+    return l(x[:13]), J_pose, _as_matrix(x[3:7])
@@ -0,0 +1,159 @@
+# Debug visualizations for ekf.py
+# Only imported when plotting is enabled, so headless runs never load
+# matplotlib or create figures.
+
+import matplotlib.pyplot as plt
+import numpy as onp
+from mpl_toolkits import mplot3d
+
+from q import _rotate_points
+
+
+def _stereo_pair(left, right):
+    fig, axs = plt.subplots(nrows=1, ncols=2)
+    axs[0].imshow(left)
+    axs[0].set_title("left")
+    axs[1].imshow(right)
+    axs[1].set_title("right")
+    plt.show()
+
+
+def _disparity(disparity, title="initial disparity"):
+    plt.figure()
+    plt.title(title)
+    plt.imshow(disparity)
+    plt.show()
+
+
+def _disparity_check(left, right, disparity, x=800, y=300):
+    # Verify results
+    fig, axs = plt.subplots(nrows=1, ncols=2)
+    axs[0].imshow(left)
+    axs[0].set_title("left")
+    axs[0].scatter(x, y, c='r')
+
+    axs[1].imshow(right)
+    axs[1].set_title("right")
+    axs[1].scatter(x, y, c='c', label="original")
+    axs[1].scatter(x - disparity[y, x], y, c='r', label="adjusted")
+    plt.legend()
+    plt.show()
+
+
+def _corners(left,
+             right,
+             corners,
+             disparity_corners,
+             disparity=None,
+             prefix=""):
+    """
+    Corners on the left image and their stereo matches on the right image,
+    plus the full disparity map when there is one.
+    """
+    if disparity is None:
+        fig, axs = plt.subplots(nrows=1, ncols=2)
+    else:
+        fig, axs = plt.subplots(nrows=2, ncols=2)
+        axs[1, 0].imshow(disparity)
+        axs[1, 0].set_title("disparity")
+        axs = axs[0]
+
+    axs[0].imshow(left)
+    axs[0].set_title(f"{prefix}corners on left")
+    axs[0].scatter(corners[:, 0], corners[:, 1], c='r')
+
+    axs[1].imshow(right)
+    axs[1].set_title(f"{prefix}corners on right")
+    axs[1].scatter(corners[:, 0], corners[:, 1], c='c', label="original")
+    axs[1].scatter(corners[:, 0] - disparity_corners,
+                   corners[:, 1],
+                   c='r',
+                   label="adjusted")
+    plt.legend()
+    plt.show()
+
+
+def _backprojection(corners, bp_x, bp_y, bp_z):
+    # Plot backprojection results (2D)
+    fig, axs = plt.subplots(nrows=2, ncols=1)
+
+    im = axs[0].scatter(corners[:, 0], corners[:, 1], c=bp_z)
+    axs[0].invert_yaxis()
+    fig.colorbar(im, ax=axs[0])
+    axs[0].set_title("x, y")
+    axs[0].set_aspect('equal', adjustable='box')
+
+    axs[1].scatter(bp_x, bp_y, c=bp_z)
+    axs[1].invert_yaxis()
+    axs[1].set_title("after back projection")
+    axs[1].set_aspect('equal', adjustable='box')
+    plt.show()
+
+    # Plot backprojected result in 3D
+    for xs, ys, title in [
+        (corners[:, 0], corners[:, 1], "image x, y with depth"),
+        (bp_x, bp_y, "backprojected x, y with depth"),
+    ]:
+        fig = plt.figure()
+        ax = plt.axes(projection='3d')
+        ax.scatter3D(xs, ys, bp_z, c=bp_z)
+        ax.set_xlabel('x')
+        ax.set_ylabel('y')
+        ax.set_zlabel('z')
+        ax.invert_xaxis()
+        ax.invert_zaxis()
+        ax.set_title(title)
+
+        # Set aspect ratio (space out the z-axis to see the depth more clearly)
+        ax.set_box_aspect((onp.ptp(corners[:, 0]), onp.ptp(corners[:, 1]),
+                           5 * onp.ptp(bp_z)))
+        plt.show()
+
+
+def _reprojection(left, projected_features):
+    plt.figure()
+    plt.imshow(left)
+    plt.scatter(projected_features[:, 0],
+                projected_features[:, 1],
+                c='r',
+                label="reprojected features")
+    plt.legend()
+    plt.show()
+
+
+def _tracks(old_left, left, good_old, good_new, title):
+    fig, axs = plt.subplots(nrows=1, ncols=2)
+    axs[0].imshow(old_left)
+    axs[0].scatter(good_old[:, 0], good_old[:, 1], c='r')
+    axs[0].set_title("old t")
+
+    axs[1].imshow(left)
+    axs[1].scatter(good_new[..., 0], good_new[..., 1], c='r')
+    axs[1].set_title(title)
+    plt.show()
+
+
+def _projected_vs_measured(left, projected, measured):
+    # Visualize measured vs observed
+    plt.figure()
+    plt.imshow(left)
+    plt.scatter(projected[:, 0], projected[:, 1], c='c', label="projected")
+    plt.scatter(measured[:, 0], measured[:, 1], c='r', label="measured")
+    plt.legend()
+    plt.show()
+
+
+def _orientation(q):
+    fig = plt.figure()
+    ax = plt.axes(projection='3d')
+
+    # Basis vectors
+    bs = _rotate_points(q.wxyz, onp.identity(3))
+
+    for x in bs:
+        ax.plot([0, x[0]], [0, x[1]], [0, x[2]])
+
+    ax.set_xlabel('x')
+    ax.set_ylabel('y')
+    ax.set_zlabel('z')
+    plt.show()
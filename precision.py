@@ -0,0 +1,55 @@
+# Numeric precision of the filter
+#
+#   float32: everything in single precision (fastest, half the memory)
+#   float64: everything in double precision
+#   mixed:   state, covariance and Jacobians stored/computed in float32, the
+#            gain and covariance update accumulated in float64
+#
+# plus an optional repair of the covariance after each update, since the
+# non-Joseph update `sigma - K @ C @ sigma` loses symmetry (and eventually
+# positive semi-definiteness) to rounding.
+
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+
+# mode: (storage dtype, accumulation dtype)
+modes = dict(
+    float32=(jnp.float32, jnp.float32),
+    float64=(jnp.float64, jnp.float64),
+    mixed=(jnp.float32, jnp.float64),
+)
+
+
+def _dtypes(mode):
+    """
+    (storage, accumulation) dtypes of a precision mode. Turns on JAX's 64-bit
+    mode if the precision mode needs it.
+    """
+    assert mode in modes, \
+        f"unknown precision {mode}, pick one of {list(modes)}"
+    storage, accumulate = modes[mode]
+    if accumulate == jnp.float64 and not jax.config.jax_enable_x64:
+        jax.config.update("jax_enable_x64", True)
+    return storage, accumulate
+
+
+@partial(jax.jit, static_argnames=("mode", ))
+def _repair(sigma, mode="symmetric"):
+    """
+    Repair a covariance matrix.
+
+    "symmetric": average with its transpose (O(n^2))
+    "psd": also clip negative eigenvalues to zero (O(n^3) eigendecomposition)
+    None: leave it alone
+    """
+    if mode is None:
+        return sigma
+    sigma = (sigma + sigma.T) / 2
+    if mode == "psd":
+        e, V = jnp.linalg.eigh(sigma)
+        sigma = (V * jnp.maximum(e, 0)) @ V.T
+    else:
+        assert mode == "symmetric", f"unknown repair {mode}"
+    return sigma
@@ -0,0 +1,131 @@
+# Trajectory recorder
+# Keeps a few small per-frame fields (pose, velocity, pose covariance) in
+# preallocated arrays instead of every full state and n x n covariance, so
+# memory stays O(T) for long sequences however many landmarks the state holds.
+# Full snapshots can be streamed to memory-mapped .npy files every k frames.
+
+import math
+import os
+
+import numpy as onp
+
+# Recordable fields, extracted from (mu, sigma)
+_fields = dict(
+    # Position (3) + orientation (wxyz, 4)
+    pose=lambda mu, sigma: mu[:7],
+    # Linear (3) + angular (3) velocity
+    velocity=lambda mu, sigma: mu[7:13],
+    pose_cov=lambda mu, sigma: sigma[:13, :13],
+    # Everything (O(n) / O(n^2) per frame)
+    state=lambda mu, sigma: mu,
+    cov=lambda mu, sigma: sigma,
+)
+
+default_fields = ("pose", "velocity", "pose_cov")
+
+
+class TrajectoryRecorder:
+    """
+    Record `fields` (see `_fields`) for up to `capacity` frames.
+
+    Arrays are allocated on the first `append()` (when the state size is
+    known) with `dtype` and read back with `recorder["pose"]` etc. With
+    `snapshot_every=k`, the full state and covariance of every k-th frame are
+    also written to <snapshot_dir>/snapshots_{mu,sigma,frames}.npy through
+    memory maps.
+    """
+
+    def __init__(self,
+                 capacity,
+                 fields=default_fields,
+                 dtype=onp.float32,
+                 snapshot_every=None,
+                 snapshot_dir="."):
+        for name in fields:
+            assert name in _fields, f"unknown field {name}"
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.dtype = dtype
+        self.snapshot_every = snapshot_every
+        self.snapshot_dir = snapshot_dir
+
+        self.count = 0
+        self.frames = onp.zeros(capacity, dtype=int)
+        self.times = onp.zeros(capacity)
+        self._data = None
+
+        self.num_snapshots = 0
+        self._snapshots = None
+
+    def _allocate(self, mu, sigma):
+        self._data = {}
+        for name in self.fields:
+            shape = onp.shape(_fields[name](mu, sigma))
+            self._data[name] = onp.zeros((self.capacity, *shape),
+                                         dtype=self.dtype)
+
+        if self.snapshot_every:
+            n = len(mu)
+            k = math.ceil(self.capacity / self.snapshot_every)
+            path = lambda x: os.path.join(self.snapshot_dir,
+                                          f"snapshots_{x}.npy")
+            open_memmap = onp.lib.format.open_memmap
+            self._snapshots = dict(
+                mu=open_memmap(path("mu"), "w+", self.dtype, (k, n)),
+                sigma=open_memmap(path("sigma"), "w+", self.dtype, (k, n, n)),
+                frames=open_memmap(path("frames"), "w+", int, (k, )),
+            )
+
+    def append(self, i, t, mu, sigma):
+        """
+        Record frame i at time t.
+        """
+        assert self.count < self.capacity, "recorder is full"
+        if self._data is None:
+            self._allocate(mu, sigma)
+
+        k = self.count
+        self.frames[k] = i
+        self.times[k] = t
+        for name in self.fields:
+            self._data[name][k] = _fields[name](mu, sigma)
+
+        if self._snapshots is not None and k % self.snapshot_every == 0:
+            s = self.num_snapshots
+            self._snapshots["mu"][s] = mu
+            self._snapshots["sigma"][s] = sigma
+            self._snapshots["frames"][s] = i
+            self.num_snapshots += 1
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        """
+        Recorded field `name` (or "frames" / "times") for the frames so far.
+        """
+        if name in ("frames", "times"):
+            return getattr(self, name)[:self.count]
+        if self._data is None:
+            raise KeyError("nothing recorded yet")
+        return self._data[name][:self.count]
+
+    @property
+    def frame_nbytes(self):
+        """
+        Bytes kept in memory per recorded frame.
+        """
+        if self._data is None:
+            return 0
+        return sum(x[0].nbytes for x in self._data.values()) + 16
+
+    @property
+    def nbytes(self):
+        return self.capacity * self.frame_nbytes
+
+    def close(self):
+        # Flush snapshots to disk
+        if self._snapshots is not None:
+            for x in self._snapshots.values():
+                x.flush()
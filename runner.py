@@ -0,0 +1,152 @@
+# Run the stereo EKF on several KITTI sequences in parallel
+# Every sequence gets its own worker process (and so its own JAX runtime) with
+# capped thread pools, so N workers on an N-core box don't oversubscribe.
+#
+#   python runner.py --seqs 00 01 02 --workers 3 --out results
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+_thread_env = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def _core_slots(workers, threads):
+    # One set of `threads` cores per concurrent worker (wrapping around when
+    # there are fewer cores than workers x threads)
+    cores = sorted(os.sched_getaffinity(0))
+    return [[cores[(k * threads + j) % len(cores)] for j in range(threads)]
+            for k in range(workers)]
+
+
+def _limit_threads(threads, cores=None):
+    # Must run before numpy / jax / cv2 are imported in the worker
+    for k in _thread_env:
+        os.environ[k] = str(threads)
+    # XLA has no flag for its CPU thread pool size: the pools size themselves
+    # from the process's CPU affinity mask, so pinning the process to `cores`
+    # is what caps them. Single-threaded Eigen keeps each op on one thread
+    flags = os.environ.get("XLA_FLAGS", "")
+    flags += (" --xla_cpu_multi_thread_eigen=false"
+              " --xla_force_host_platform_device_count=1")
+    os.environ["XLA_FLAGS"] = flags.strip()
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+
+
+def _worker(args):
+    seq, root, num_frames, out_dir, threads, profile, slots = args
+    # Take a free set of cores for the lifetime of this worker
+    cores = slots.get() if slots is not None else None
+    try:
+        return _run_worker(seq, root, num_frames, out_dir, threads, profile,
+                           cores)
+    finally:
+        if cores is not None:
+            slots.put(cores)
+
+
+def _run_worker(seq, root, num_frames, out_dir, threads, profile, cores):
+    _limit_threads(threads, cores)
+
+    import cv2
+    import numpy as onp
+
+    import ekf
+
+    cv2.setNumThreads(threads)
+    root = root or ekf.dataset_root
+    ekf.show = False
+    ekf.interactive = False
+    # Per-frame prints sync the device and skew the timing
+    ekf.verbose = False
+    ekf.profile = profile
+
+    out_dir = Path(out_dir) / seq
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    t0 = time.perf_counter()
+    result = ekf.run(seq, root, num_frames, out_dir=str(out_dir))
+    wall = time.perf_counter() - t0
+
+    # Position (3) + orientation quaternion (4)
+    poses = result["recorder"]["pose"]
+    onp.save(out_dir / "trajectory.npy", poses)
+    onp.save(out_dir / "times.npy", onp.asarray(result["times"]))
+
+    summary = dict(seq=seq,
+                   frames=len(poses),
+                   wall_s=wall,
+                   fps=len(poses) / wall,
+                   stages_s=result["prof"].totals())
+    with open(out_dir / "timing.json", "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def run_sequences(seqs,
+                  root,
+                  out_dir="results",
+                  num_frames=None,
+                  workers=None,
+                  threads=1,
+                  profile=False):
+    """
+    Run ekf.run on each sequence in its own process; trajectories and timing
+    go to <out_dir>/<seq>/ and a combined summary to <out_dir>/summary.json.
+    """
+    workers = workers or min(len(seqs), os.cpu_count() // threads or 1)
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    # Spawned (not forked) workers, one sequence per process: every sequence
+    # starts from a fresh JAX runtime
+    ctx = multiprocessing.get_context("spawn")
+    summaries = []
+    t0 = time.perf_counter()
+    with ctx.Manager() as manager, ctx.Pool(workers,
+                                            maxtasksperchild=1) as pool:
+        # Pin the workers to disjoint cores where the platform allows it
+        # (Linux); elsewhere only the thread pool environment variables apply
+        slots = None
+        if hasattr(os, "sched_setaffinity"):
+            slots = manager.Queue()
+            for cores in _core_slots(workers, threads):
+                slots.put(cores)
+        jobs = [(seq, root, num_frames, out_dir, threads, profile, slots)
+                for seq in seqs]
+        for summary in pool.imap_unordered(_worker, jobs):
+            print(f"{summary['seq']}: {summary['frames']} frames, "
+                  f"{summary['fps']:.1f} fps")
+            summaries.append(summary)
+
+    summaries.sort(key=lambda s: s["seq"])
+    with open(Path(out_dir) / "summary.json", "w") as f:
+        json.dump(dict(wall_s=time.perf_counter() - t0, sequences=summaries),
+                  f,
+                  indent=2)
+    return summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seqs",
+                        nargs="+",
+                        default=[f"{i:02d}" for i in range(11)])
+    parser.add_argument("--root", default=None)
+    parser.add_argument("--out", default="results")
+    parser.add_argument("--frames", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
+    run_sequences(args.seqs,
+                  args.root,
+                  out_dir=args.out,
+                  num_frames=args.frames,
+                  workers=args.workers,
+                  threads=args.threads,
+                  profile=args.profile)
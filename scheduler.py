@@ -0,0 +1,157 @@
+# Real-time frame scheduler
+# Replays a sequence at the pace of its capture timestamps (times.txt): frame i
+# becomes available at t0 + (times[i] - times[t0's frame]) / speed and its
+# result is due `deadline` seconds later (one frame period by default). When
+# processing falls behind, load is shed in a controlled way:
+#   - frames are skipped (prediction only, with their real dt) whenever the
+#     next frame has already arrived, so the filter always works on the newest
+#     one and latency stays bounded
+#   - landmark discovery (detection + stereo) is postponed to a frame with
+#     enough slack left for it, at most `max_postpone` frames in a row
+#   - after a deadline miss, discovery only refills up to `cap_features`
+#     landmarks (and retires the worst tracks beyond that) for `window` frames
+#
+# The first scheduled frame compiles the filter kernels, so the clock starts
+# once it is done.
+
+import time
+from collections import deque
+
+import numpy as onp
+
+
+class DeadlineScheduler:
+    """
+    Paces and sheds the frames of a sequence with timestamps `times` (s).
+
+    The front end calls `wait(i)` before working on frame i, then asks
+    `skip(i)`, `discover(i)` and `feature_cap()`; the filter calls
+    `done(i, ...)` once frame i's state is final.
+    """
+
+    def __init__(self,
+                 times,
+                 speed=1.0,
+                 deadline=None,
+                 max_postpone=10,
+                 cap_features=None,
+                 window=10):
+        self.times = onp.asarray(times)
+        self.speed = speed
+        period = onp.median(onp.diff(self.times)) if len(times) > 1 else 0.1
+        self.deadline = period / speed if deadline is None else deadline
+        self.max_postpone = max_postpone
+        self.cap_features = cap_features
+
+        self._t0 = None
+        self._first = None
+        self._started = {}
+        self._recent_misses = deque(maxlen=window)
+        self._postponed_in_row = 0
+        # Running estimate (EMA) of how long a discovery frame takes
+        self._discover_cost = 0.0
+
+        # Per-frame log: (i, latency after arrival, skipped, discovery, missed)
+        self.log = []
+        self.postponed = 0
+        self.capped = 0
+
+    def arrival(self, i):
+        """
+        Wall-clock time (time.perf_counter) at which frame i is captured, None
+        before the clock has started.
+        """
+        if self._t0 is None:
+            return None
+        elapsed = self.times[i] - self.times[self._first]
+        return self._t0 + elapsed / self.speed
+
+    def wait(self, i):
+        """
+        Block until frame i has arrived.
+        """
+        arrival = self.arrival(i)
+        if arrival is not None:
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self._started[i] = time.perf_counter()
+
+    def skip(self, i):
+        """
+        Whether to drop frame i (prediction only): the next one has already
+        arrived, so working on frame i would only fall further behind.
+        """
+        if self._t0 is None or i + 1 >= len(self.times):
+            return False
+        return time.perf_counter() >= self.arrival(i + 1)
+
+    def discover(self, i):
+        """
+        Whether a due discovery can run on frame i, i.e. it is expected to
+        finish before frame i's deadline. Postponed at most `max_postpone`
+        frames in a row.
+        """
+        if self._t0 is None or self._postponed_in_row >= self.max_postpone:
+            self._postponed_in_row = 0
+            return True
+        due = self.arrival(i) + self.deadline
+        if time.perf_counter() + self._discover_cost <= due:
+            self._postponed_in_row = 0
+            return True
+        self._postponed_in_row += 1
+        self.postponed += 1
+        return False
+
+    def feature_cap(self):
+        """
+        Most landmarks to keep at the next discovery, None for no cap.
+        """
+        if self.cap_features is None or not any(self._recent_misses):
+            return None
+        self.capped += 1
+        return self.cap_features
+
+    def done(self, i, skipped=False, discovery=False):
+        """
+        Frame i's filter state is final.
+        """
+        now = time.perf_counter()
+        if discovery and i in self._started:
+            cost = now - self._started[i]
+            self._discover_cost = (cost if not self._discover_cost else
+                                   0.8 * self._discover_cost + 0.2 * cost)
+        self._started.pop(i, None)
+
+        if self._t0 is None:
+            # Warm-up frame: start the clock with the next frame arriving now
+            if i + 1 < len(self.times):
+                self._t0, self._first = now, i + 1
+            return
+
+        latency = now - self.arrival(i)
+        missed = latency > self.deadline
+        self._recent_misses.append(missed)
+        self.log.append((i, latency, skipped, discovery, missed))
+
+    def summary(self):
+        """
+        Scheduled frame counts, deadline misses and latency percentiles (ms).
+        """
+        if not self.log:
+            return dict(frames=0)
+        _, latency, skipped, discovery, missed = (onp.array(x)
+                                                  for x in zip(*self.log))
+        ms = 1e3 * latency
+        p50, p95, p99 = onp.percentile(ms, (50, 95, 99))
+        return dict(frames=len(ms),
+                    deadline_ms=float(1e3 * self.deadline),
+                    missed=int(missed.sum()),
+                    skipped=int(skipped.sum()),
+                    discoveries=int(discovery.sum()),
+                    postponed=self.postponed,
+                    capped=self.capped,
+                    p50_ms=float(p50),
+                    p95_ms=float(p95),
+                    p99_ms=float(p99),
+                    max_ms=float(ms.max()))
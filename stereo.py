@@ -0,0 +1,80 @@
+# Sparse stereo matching
+# Only a handful of corners need a depth, so instead of a full-frame StereoSGBM
+# pass we match a small window around each corner along its epipolar line (the
+# same row in the rectified right image).
+
+import numpy as onp
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _sparse_disparity(left,
+                      right,
+                      corners,
+                      min_disp=0,
+                      num_disp=64,
+                      block_size=11,
+                      uniqueness=0.1):
+    """
+    Disparity (in pixels) at each corner (M, 2) of the rectified stereo pair.
+
+    Each corner's block_size x block_size window in the left image is compared
+    (sum of absolute differences) against the right image at x - d for
+    d in [min_disp, min_disp + num_disp), followed by a parabolic sub-pixel
+    fit. Corners without a unique match, or whose search range leaves the
+    image, get a disparity of -1.
+    """
+    corners = onp.reshape(corners, (-1, 2)).astype(int)
+    disparity = -onp.ones(len(corners))
+    if len(corners) == 0:
+        return disparity
+
+    h, w = left.shape
+    r = block_size // 2
+    x, y = corners[:, 0], corners[:, 1]
+
+    # Pad so that every window (and every search position) is in bounds
+    pad = r + min_disp + num_disp
+    left = onp.pad(left.astype(onp.int16), pad, mode="edge")
+    right = onp.pad(right.astype(onp.int16), pad, mode="edge")
+    x, y = x + pad, y + pad
+
+    rows = y[:, None] + onp.arange(-r, r + 1)  # M x b
+    cols = x[:, None] + onp.arange(-r, r + 1)  # M x b
+    patches = left[rows[:, :, None], cols[:, None, :]]  # M x b x b
+
+    # Right image strip covering every candidate disparity, far end first
+    x0 = x - (min_disp + num_disp - 1) - r
+    strip_cols = x0[:, None] + onp.arange(num_disp + block_size - 1)
+    strips = right[rows[:, :, None], strip_cols[:, None, :]]
+    windows = sliding_window_view(strips, block_size, axis=2)  # M x b x D x b
+
+    cost = onp.abs(windows - patches[:, :, None, :]).sum(axis=(1, 3))  # M x D
+    # Reorder so that cost[:, k] is the cost of disparity min_disp + k
+    cost = cost[:, ::-1].astype(onp.float64)
+
+    best = onp.argmin(cost, axis=1)
+    m = onp.arange(len(cost))
+    best_cost = cost[m, best]
+
+    # Uniqueness: the best match must beat every candidate that is not
+    # adjacent to it by a margin (same idea as StereoSGBM's uniquenessRatio)
+    others = cost.copy()
+    for k in (-1, 0, 1):
+        others[m, onp.clip(best + k, 0, num_disp - 1)] = onp.inf
+    unique = best_cost * (1 + uniqueness) < others.min(axis=1)
+
+    # Sub-pixel refinement
+    lo = cost[m, onp.clip(best - 1, 0, num_disp - 1)]
+    hi = cost[m, onp.clip(best + 1, 0, num_disp - 1)]
+    denom = lo - 2 * best_cost + hi
+    inner = (best > 0) & (best < num_disp - 1) & (denom > 0)
+    offset = onp.where(inner, 0.5 * (lo - hi) / onp.where(inner, denom, 1), 0)
+
+    # The whole search range must lie inside the original image
+    in_bounds = ((corners[:, 0] - r - (min_disp + num_disp - 1) >= 0) &
+                 (corners[:, 0] + r < w) & (corners[:, 1] - r >= 0) &
+                 (corners[:, 1] + r < h))
+
+    valid = unique & in_bounds
+    disparity[valid] = (min_disp + best + offset)[valid]
+    return disparity
@@ -0,0 +1,192 @@
+# Noise parameter sweep
+# Runs the front end (image I/O, tracking, stereo) once, then filters the
+# recorded measurements with every combination of noise parameters as a batch
+# of independent EKFs (`jax.vmap` over the scanned predict/update step) and
+# reports the trajectory error of each (see evaluate.py).
+#
+#   python sweep.py --seq 00 --frames 100 --q-pose 0.01 0.1 1 --r-pixel 1e-3 1
+
+import argparse
+import itertools
+import json
+import time
+
+import jax.numpy as jnp
+import numpy as onp
+
+import ekf
+from dataset import KittiSequence
+from engine import _init_filter, _run_batched
+from evaluate import ate, evaluate
+from frontend import FrontEnd
+from precision import _dtypes
+
+# Parameters that can be swept, with their defaults from ekf.py
+_params = ("q_pose", "q_landmark", "r_pixel", "sigma0_scale", "r_stereo",
+           "v0")
+
+
+def _record(frontend):
+    """
+    Run the front end over the whole sequence and stack its output into
+    engine._run inputs.
+
+    Returns the first frame's landmarks (N, 3) and (dts, ys, observed,
+    landmarks).
+    """
+    first = frontend.first()
+    times = frontend.sequence.times
+    # Map updates on discovery frames, no-ops in between
+    nothing = (False, onp.zeros_like(first.features),
+               onp.zeros_like(first.features_cov),
+               onp.zeros_like(first.new), onp.zeros_like(first.active))
+
+    dts, ys, observed, landmarks = [], [], [], []
+    for frame in frontend:
+        dts.append(frame.t - times[frame.i - 1])
+        ys.append(frame.p1.flatten())
+        observed.append(frame.st == 1)
+        landmarks.append(nothing if frame.new is None else (
+            True, frame.features, frame.features_cov, frame.new,
+            frame.active))
+
+    stack = lambda x: jnp.asarray(onp.array(x))
+    inputs = (stack(dts), stack(ys), stack(observed),
+              tuple(stack(x) for x in zip(*landmarks)))
+    return first.features, inputs
+
+
+def _json(x):
+    # Diverged configurations have NaN errors, which JSON has no value for
+    if isinstance(x, float) and not onp.isfinite(x):
+        return None
+    if isinstance(x, dict):
+        return {k: _json(v) for k, v in x.items()}
+    if isinstance(x, list):
+        return [_json(v) for v in x]
+    return x
+
+
+def _configs(grid):
+    names = list(grid)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*grid.values())
+    ]
+
+
+def sweep(seq="00", root=ekf.dataset_root, num_frames=None, **grid):
+    """
+    Filter `seq` once per combination of the parameter lists in `grid`
+    (any of `_params`, missing ones use the ekf.py default).
+
+    Returns one dict per configuration with its parameters, the position RMSE
+    (unaligned), final position error, ATE (m) and KITTI RPE (%, deg/m)
+    against ground truth, sorted by RMSE.
+    """
+    grid = {k: grid.get(k, [getattr(ekf, k)]) for k in _params}
+    configs = _configs(grid)
+    storage, accumulate = _dtypes(ekf.precision)
+
+    sequence = KittiSequence(root, seq)
+    gt_poses = sequence.poses
+    assert gt_poses is not None, f"no ground truth for sequence {seq}"
+
+    frontend = FrontEnd(sequence,
+                        num_frames=num_frames,
+                        max_features=ekf.max_features,
+                        target_features=ekf.target_features,
+                        max_misses=ekf.max_misses,
+                        discover_freq=ekf.discover_freq,
+                        discover_features=ekf.discover_features,
+                        sparse_stereo=ekf.sparse_stereo,
+                        prefetch_depth=ekf.prefetch_depth,
+                        fb_threshold=ekf.fb_threshold,
+                        grid=ekf.detect_grid,
+                        min_distance=ekf.min_distance,
+                        disparity_cache=ekf.disparity_cache,
+                        disparity_cache_bytes=ekf.disparity_cache_bytes)
+    t0 = time.perf_counter()
+    features0, inputs = _record(frontend)
+    t_frontend = time.perf_counter() - t0
+    T = len(inputs[0])
+    print(f"front end: {T} frames in {t_frontend:.2f} s")
+
+    # Stack the per-configuration initial state and noise along a batch axis
+    init = [
+        _init_filter(features0, jnp.asarray(c["v0"], dtype=float),
+                     c["q_pose"], c["q_landmark"], c["r_pixel"],
+                     c["sigma0_scale"]) for c in configs
+    ]
+    mu0, sigma0, Q, R = (jnp.stack(x).astype(storage) for x in zip(*init))
+    r_stereo = jnp.array([c["r_stereo"] for c in configs])
+
+    t0 = time.perf_counter()
+    mus, _ = _run_batched(mu0,
+                          sigma0,
+                          Q,
+                          R,
+                          sequence.camera,
+                          *inputs,
+                          r_stereo,
+                          accumulate=accumulate,
+                          repair=ekf.repair,
+                          # Only the means are scored: don't stack a
+                          # covariance per frame and configuration
+                          sigmas=None)
+    mus = onp.asarray(mus)
+    t_filter = time.perf_counter() - t0
+    print(f"filters: {len(configs)} x {T} frames in {t_filter:.2f} s")
+
+    t0 = time.perf_counter()
+    positions = mus[:, :, :3]
+    gt = gt_poses[1:T + 1]
+    rmse = ate(positions, gt[:, :, -1], align=None)
+    final = onp.linalg.norm(positions[:, -1] - gt[-1, :, -1], axis=-1)
+    accuracy = evaluate(mus[:, :, :7], gt, ekf.rpe_lengths, ekf.rpe_step)
+    print(f"evaluation: {len(configs)} x {T} frames in "
+          f"{time.perf_counter() - t0:.2f} s")
+
+    results = [
+        dict(**{k: onp.asarray(v).tolist() for k, v in c.items()},
+             rmse=float(e),
+             final_error=float(f),
+             ate=float(a),
+             t_err=float(t),
+             r_err=float(r)) for c, e, f, a, t, r in zip(
+                 configs, rmse, final, accuracy["ate"], accuracy["t_err"],
+                 accuracy["r_err"])
+    ]
+    # NaN (diverged) configurations last
+    results.sort(key=lambda r: (onp.isnan(r["rmse"]), r["rmse"]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seq", default="00")
+    parser.add_argument("--root", default=ekf.dataset_root)
+    parser.add_argument("--frames", type=int, default=None)
+    parser.add_argument("--out", default="sweep.json")
+    for name in _params:
+        if name == "v0":
+            # One "vx,vy,vz" triple per value
+            parser.add_argument(
+                "--v0",
+                nargs="+",
+                type=lambda s: [float(x) for x in s.split(",")])
+        else:
+            parser.add_argument(f"--{name.replace('_', '-')}",
+                                nargs="+",
+                                type=float)
+    args = parser.parse_args()
+
+    grid = {k: getattr(args, k) for k in _params if getattr(args, k)}
+    results = sweep(args.seq, args.root, args.frames, **grid)
+
+    for r in results:
+        params = ", ".join(f"{k}={r[k]}" for k in _params)
+        print(f"rmse {r['rmse']:8.4f} m, final {r['final_error']:8.4f} m, "
+              f"ate {r['ate']:8.4f} m, rpe {r['t_err']:7.3f} %: {params}")
+    with open(args.out, "w") as f:
+        json.dump(_json(results), f, indent=2, allow_nan=False)
@@ -0,0 +1,83 @@
+# Pyramidal LK tracker
+# Keeps the previous frame between calls and validates tracks with a
+# forward-backward check: tracking p1 back to the previous frame should land on
+# p0 again.
+#
+# NOTE: the Python bindings of calcOpticalFlowPyrLK only take images, not the
+# pyramids from cv2.buildOpticalFlowPyramid, so pyramids can't be cached across
+# calls from here. The backward pass is instead started at p0 (the expected
+# answer), so it converges in very few iterations for good tracks.
+
+import cv2
+import numpy as onp
+
+
+class LKTracker:
+    """
+    Track points from the previous frame (see `reset`) to the next one.
+
+    A track is good when both LK passes succeed and the forward-backward error
+    |p0 - back(forward(p0))| is below `fb_threshold` pixels. The
+    forward-backward error is also returned as a per-track quality score
+    (lower is better, inf when not tracked).
+    """
+
+    def __init__(self,
+                 win_size=(15, 15),
+                 max_level=2,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10,
+                           0.03),
+                 fb_threshold=1.0):
+        self.win_size = win_size
+        self.max_level = max_level
+        self.criteria = criteria
+        self.fb_threshold = fb_threshold
+        self._prev = None
+
+    def _lk(self, prev, img, p, guess=None):
+        flags = 0 if guess is None else cv2.OPTFLOW_USE_INITIAL_FLOW
+        guess = None if guess is None else guess.copy()
+        return cv2.calcOpticalFlowPyrLK(prev,
+                                        img,
+                                        p,
+                                        guess,
+                                        winSize=self.win_size,
+                                        maxLevel=self.max_level,
+                                        criteria=self.criteria,
+                                        flags=flags)
+
+    def reset(self, img):
+        """
+        Make `img` the previous frame.
+        """
+        self._prev = img
+
+    def track(self, img, p0, active):
+        """
+        Track the active slots of p0 (S, 2) into `img`, which becomes the
+        previous frame for the next call.
+
+        Returns p1 (S, 2), the status (S,) (1 for good tracks) and the
+        forward-backward error (S,). Empty slots keep their old location and
+        are never good.
+        """
+        assert self._prev is not None, "call reset() with the first frame"
+
+        p0 = p0.astype(onp.float32).reshape((-1, 2))
+        p1 = p0.copy()
+        st = onp.zeros(len(p0), dtype=onp.uint8)
+        fb = onp.full(len(p0), onp.inf)
+        if active.any():
+            p = p0[active].reshape((-1, 1, 2))
+            forward, st_f, _ = self._lk(self._prev, img, p)
+            # All tracks are checked in one backward pass
+            back, st_b, _ = self._lk(img, self._prev, forward, guess=p)
+
+            error = onp.linalg.norm((back - p).reshape((-1, 2)), axis=-1)
+            ok = (st_f.ravel() == 1) & (st_b.ravel() == 1)
+            p1[active] = forward.reshape((-1, 2))
+            fb[active] = onp.where(ok, error, onp.inf)
+            st[active] = fb[active] < self.fb_threshold
+
+        self._prev = img
+        return p1, st, fb
@@ -0,0 +1,188 @@
+# Command line entry point
+# Runs the stereo EKF unattended (no plots, no IPython breakpoints) and reports
+# throughput, per-frame latency percentiles, peak memory and, for sequences
+# with ground truth, trajectory error (see evaluate.py), so runs can be batched
+# and builds compared.
+#
+#   python -m vo run --seq 00 --frames 500 --discover-freq 5 --max-corners 50
+#   python -m vo run --seq 01 --r-pixel 1e-2 --precision mixed --out results/01
+#   python -m vo run --seq 00 --realtime --speed 2 --cap-features 5
+#   python -m vo run --seq 00 --landmark-map --map-min-ncc 0.7
+
+import argparse
+import json
+import resource
+import sys
+import time
+from pathlib import Path
+
+import numpy as onp
+
+import ekf
+from sweep import _json
+
+# ekf.py settings that can be set from the command line: (flag, setting, type)
+_settings = (
+    ("--discover-freq", "discover_freq", int),
+    ("--max-misses", "max_misses", int),
+    # Landmark slots in the state, i.e. the most corners (maxCorners) tracked
+    ("--max-corners", "max_features", int),
+    ("--target-corners", "target_features", int),
+    ("--min-distance", "min_distance", int),
+    ("--fb-threshold", "fb_threshold", float),
+    ("--q-pose", "q_pose", float),
+    ("--q-landmark", "q_landmark", float),
+    ("--r-pixel", "r_pixel", float),
+    ("--sigma0-scale", "sigma0_scale", float),
+    ("--r-stereo", "r_stereo", float),
+    ("--precision", "precision", str),
+    ("--repair", "repair", lambda s: None if s == "None" else s),
+    ("--disparity-cache", "disparity_cache", str),
+    # Real-time replay (with --realtime)
+    ("--speed", "realtime_speed", float),
+    ("--deadline", "deadline", float),
+    ("--max-postpone", "max_postpone", int),
+    ("--cap-features", "cap_features", int),
+    # Landmark map (with --landmark-map)
+    ("--map-voxel-size", "map_voxel_size", float),
+    ("--map-max-depth", "map_max_depth", float),
+    ("--map-min-ncc", "map_min_ncc", float),
+)
+
+
+def _peak_rss():
+    # Peak resident set size in bytes (ru_maxrss is in KiB on Linux)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else 1024 * peak
+
+
+def _summary(latencies, wall):
+    """
+    Throughput and latency summary of a run with per-frame `latencies` (s)
+    taking `wall` seconds overall.
+    """
+    ms = 1e3 * onp.asarray(latencies)
+    p50, p95, p99 = onp.percentile(ms, (50, 95, 99)) if len(ms) else [0] * 3
+    return dict(frames=len(ms),
+                wall_s=wall,
+                fps=len(ms) / wall,
+                # First frame includes the JIT compilation
+                first_ms=float(ms[0]) if len(ms) else None,
+                p50_ms=float(p50),
+                p95_ms=float(p95),
+                p99_ms=float(p99),
+                max_ms=float(ms.max(initial=0)),
+                peak_rss_mb=_peak_rss() / 2**20)
+
+
+def _run(args):
+    ekf.show = False
+    ekf.interactive = False
+    ekf.verbose = args.verbose
+    ekf.pipeline = args.pipeline
+    ekf.realtime = args.realtime
+    ekf.landmark_map = args.landmark_map
+    ekf.sparse_stereo = not args.dense_stereo
+    ekf.profile = args.profile
+    for flag, name, _ in _settings:
+        value = getattr(args, flag[2:].replace("-", "_"))
+        if value is not None:
+            setattr(ekf, name, value)
+    if args.v0 is not None:
+        ekf.v0 = args.v0
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    t0 = time.perf_counter()
+    result = ekf.run(args.seq, args.root, args.frames, out_dir=str(out_dir))
+    wall = time.perf_counter() - t0
+
+    summary = _summary(result["latencies"], wall)
+    settings = {name: getattr(ekf, name) for _, name, _ in _settings}
+    scheduler = result["scheduler"]
+    realtime = scheduler.summary() if scheduler is not None else None
+    accuracy = result["accuracy"]
+    if accuracy is not None:
+        accuracy = {k: onp.asarray(v).tolist() for k, v in accuracy.items()}
+    onp.save(out_dir / "trajectory.npy", result["recorder"]["pose"])
+    with open(out_dir / "summary.json", "w") as f:
+        json.dump(_json(
+            dict(seq=args.seq,
+                 settings=settings,
+                 realtime=realtime,
+                 accuracy=accuracy,
+                 **summary)),
+                  f,
+                  indent=2,
+                  default=str)
+
+    print(f"seq {args.seq}: {summary['frames']} frames in "
+          f"{summary['wall_s']:.2f} s ({summary['fps']:.2f} fps)")
+    print(f"latency: p50 {summary['p50_ms']:.2f} ms, "
+          f"p95 {summary['p95_ms']:.2f} ms, p99 {summary['p99_ms']:.2f} ms "
+          f"(first frame {summary['first_ms']:.2f} ms)")
+    print(f"peak memory: {summary['peak_rss_mb']:.1f} MiB")
+    if accuracy is not None:
+        print(f"accuracy: ATE {accuracy['ate']:.4f} m, RPE "
+              f"{accuracy['t_err']:.4f} %, {accuracy['r_err']:.6f} deg/m")
+    if realtime is not None and realtime["frames"]:
+        print(f"real time: {realtime['missed']}/{realtime['frames']} "
+              f"deadlines "
+              f"({realtime['deadline_ms']:.1f} ms) missed, "
+              f"{realtime['skipped']} frames skipped, "
+              f"{realtime['postponed']} discoveries postponed, "
+              f"{realtime['capped']} capped; latency after capture p99 "
+              f"{realtime['p99_ms']:.2f} ms")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="vo")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="filter a sequence unattended")
+    run.add_argument("--seq", default="00")
+    run.add_argument("--root", default=ekf.dataset_root)
+    run.add_argument("--frames",
+                     type=int,
+                     default=None,
+                     help="number of frames (default: whole sequence)")
+    run.add_argument("--out", default=".")
+    run.add_argument("--verbose",
+                     action="store_true",
+                     help="per-frame debug prints")
+    run.add_argument("--pipeline",
+                     action="store_true",
+                     help="run the front end on its own thread")
+    run.add_argument("--dense-stereo",
+                     action="store_true",
+                     help="full-frame StereoSGBM instead of sparse matching "
+                     "(see --disparity-cache)")
+    run.add_argument("--realtime",
+                     action="store_true",
+                     help="pace frames by their timestamps, shed load when "
+                     "behind (see scheduler.py)")
+    run.add_argument("--landmark-map",
+                     action="store_true",
+                     help="keep retired landmarks and re-activate them when "
+                     "they come back into view (see mapping.py, not with "
+                     "--pipeline)")
+    run.add_argument("--profile",
+                     action="store_true",
+                     help="write per-stage profile.csv / profile.json")
+    # Defaults come from ekf.py
+    for flag, name, type_ in _settings:
+        run.add_argument(flag, type=type_, default=None, help=f"ekf.{name}")
+    run.add_argument("--v0",
+                     type=lambda s: [float(x) for x in s.split(",")],
+                     default=None,
+                     help="initial velocity vx,vy,vz (m/s)")
+    run.set_defaults(fn=_run)
+
+    args = parser.parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()